@@ -12,3 +12,17 @@ ADMIN_ID = 6239774927
 
 # 4. Link to your UPI QR Code image
 PAYMENT_IMAGE_URL = "https://cdn.discordapp.com/attachments/888361275464220733/1451949298928455831/Screenshot_20251029-1135273.png?ex=698d3f68&is=698bede8&hm=d59390c159648c0df2b5b1f9fba5420ee3a7223c95dc47e22d1babf4933cebf0&"
+
+# 5. Storage backend: "mongo" (production), "sqlite" (single node) or "memory" (tests/benchmarks)
+# Can be overridden per run with the WALLET_STORAGE_BACKEND environment variable
+STORAGE_BACKEND = "mongo"
+SQLITE_PATH = "wallet.db"
+# Wallet layout: "classic" (parallel holdings/invested_amt/earned_amt maps) or "compact"
+# (one wallet.positions.SYM = {q, i, e} sub-document). Existing wallets are converted on startup
+WALLET_SCHEMA = "classic"
+
+# 6. Optional live admin dashboard (server-sent events). Leave DASHBOARD_PORT = None to disable
+# Open http://DASHBOARD_HOST:DASHBOARD_PORT/?token=DASHBOARD_TOKEN
+DASHBOARD_HOST = "127.0.0.1"
+DASHBOARD_PORT = None
+DASHBOARD_TOKEN = ""
@@ -0,0 +1,189 @@
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.ext import Application
+
+from config import DASHBOARD_HOST, DASHBOARD_PORT, DASHBOARD_TOKEN
+from database import count_pending_transactions, get_current_token_stats, get_platform_profit_by_token, get_daily_stats
+from market import engine, TICK_SECONDS
+
+try:
+    from aiohttp import web
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE_SECONDS = 60   # the platform-wide aggregations are heavy, refresh them less often than ticks
+LATENCY_WINDOW = 500
+
+# ==========================================
+# 1. HANDLER LATENCY
+# ==========================================
+class LatencyStats:
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self.total = 0
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+        self.total += 1
+
+    def snapshot(self):
+        if not self._samples:
+            return {"count": self.total, "p50_ms": 0, "p95_ms": 0, "max_ms": 0}
+        ordered = sorted(self._samples)
+        pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+        return {"count": self.total, "p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": round(ordered[-1] * 1000, 1)}
+
+latency = LatencyStats()
+
+class TimedApplication(Application):
+    """ Application that records how long each update spends in its handlers """
+    async def process_update(self, update):
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            latency.record(time.perf_counter() - started)
+
+# ==========================================
+# 2. SHARED FEED
+# ==========================================
+class DashboardFeed:
+    """
+    Computes one snapshot per tick and fans it out to every connected viewer, so the
+    database cost is the same for one admin tab or fifty. Nothing runs without viewers.
+    """
+    def __init__(self):
+        self.viewers = 0
+        self.version = 0
+        self.latest = None
+        self._changed = asyncio.Event()
+        self._aggregates = None
+        self._aggregates_at = 0.0
+
+    async def publish(self):
+        if not self.viewers: return
+        now = time.time()
+        if self._aggregates is None or now - self._aggregates_at >= AGGREGATE_SECONDS:
+            prices = engine.prices() if engine.loaded else None
+            stats, profits, daily = await asyncio.to_thread(
+                lambda: (get_current_token_stats(prices), get_platform_profit_by_token(prices), get_daily_stats())
+            )
+            self._aggregates = {"tvl": stats, "profits": profits, "daily": daily, "computed_at": now}
+            self._aggregates_at = now
+
+        pending = await asyncio.to_thread(count_pending_transactions)
+        self.latest = json.dumps({
+            "ts": now,
+            "prices": engine.prices() if engine.loaded else {},
+            "pending": pending,
+            "latency": latency.snapshot(),
+            "aggregates": self._aggregates,
+        })
+        self.version += 1
+        # Wake everyone currently waiting, then arm a fresh event for the next tick
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, seen_version):
+        while self.version == seen_version:
+            await self._changed.wait()
+        return self.version, self.latest
+
+feed = DashboardFeed()
+
+async def dashboard_feed_job(context):
+    await feed.publish()
+
+# ==========================================
+# 3. HTTP SERVER
+# ==========================================
+PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>Wallet Bot Dashboard</title>
+<style>body{font-family:monospace;background:#111;color:#ddd;margin:2em}table{border-collapse:collapse;margin-bottom:1.5em}
+td,th{padding:2px 12px;text-align:right}th{color:#888}h3{margin-bottom:.3em}.up{color:#3c3}.down{color:#e44}</style></head>
+<body><h2>🏦 Wallet Bot - live</h2><div id="status">connecting...</div>
+<h3>Queues &amp; latency</h3><table id="ops"></table>
+<h3>Market</h3><table id="prices"></table>
+<h3>Platform (refreshed every minute)</h3><table id="agg"></table>
+<script>
+const last = {};
+const row = (cells, tag) => "<tr>" + cells.map(c => `<${tag||"td"}>${c}</${tag||"td"}>`).join("") + "</tr>";
+const es = new EventSource("events" + location.search);
+es.onmessage = (e) => {
+  const d = JSON.parse(e.data);
+  document.getElementById("status").textContent = "updated " + new Date(d.ts * 1000).toLocaleTimeString();
+  document.getElementById("ops").innerHTML =
+    row(["pending deposits", "pending withdrawals", "updates", "p50 ms", "p95 ms", "max ms"], "th") +
+    row([d.pending.deposit, d.pending.withdraw, d.latency.count, d.latency.p50_ms, d.latency.p95_ms, d.latency.max_ms]);
+  let html = row(["symbol", "price"], "th");
+  for (const [sym, p] of Object.entries(d.prices)) {
+    const cls = last[sym] === undefined || p === last[sym] ? "" : (p > last[sym] ? "up" : "down");
+    html += `<tr><td>${sym}</td><td class="${cls}">${p}</td></tr>`; last[sym] = p;
+  }
+  document.getElementById("prices").innerHTML = html;
+  const a = d.aggregates || {tvl: [], profits: [], daily: {}};
+  const profit = Object.fromEntries(a.profits.map(p => [p.symbol, p.net_profit]));
+  html = row(["symbol", "value locked", "held", "user profit"], "th");
+  for (const t of a.tvl) html += row([t.symbol, t.current_value.toFixed(2), t.total_held, (profit[t.symbol] || 0).toFixed(2)]);
+  html += row(["new users today", a.daily.new_users ?? 0, "first deposits", a.daily.first_deposits ?? 0]);
+  document.getElementById("agg").innerHTML = html;
+};
+es.onerror = () => { document.getElementById("status").textContent = "disconnected, retrying..."; };
+</script></body></html>"""
+
+def _authorized(request):
+    return not DASHBOARD_TOKEN or request.query.get("token") == DASHBOARD_TOKEN
+
+async def index(request):
+    if not _authorized(request): raise web.HTTPUnauthorized()
+    return web.Response(text=PAGE, content_type="text/html")
+
+async def events(request):
+    if not _authorized(request): raise web.HTTPUnauthorized()
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await resp.prepare(request)
+
+    feed.viewers += 1
+    try:
+        if feed.latest is None:
+            await feed.publish()
+        if feed.latest is not None:
+            await resp.write(f"data: {feed.latest}\n\n".encode())
+        seen = feed.version
+        while True:
+            seen, payload = await feed.wait(seen)
+            await resp.write(f"data: {payload}\n\n".encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        feed.viewers -= 1
+    return resp
+
+_runner = None
+
+async def start_dashboard(app: Application):
+    global _runner
+    if DASHBOARD_PORT is None: return
+    if not HAS_AIOHTTP:
+        logger.warning("⚠️ aiohttp not found. Dashboard disabled.")
+        return
+    web_app = web.Application()
+    web_app.router.add_get("/", index)
+    web_app.router.add_get("/events", events)
+    _runner = web.AppRunner(web_app)
+    await _runner.setup()
+    await web.TCPSite(_runner, DASHBOARD_HOST, DASHBOARD_PORT).start()
+    app.job_queue.run_repeating(dashboard_feed_job, interval=TICK_SECONDS, first=TICK_SECONDS)
+    logger.info(f"📊 Dashboard listening on http://{DASHBOARD_HOST}:{DASHBOARD_PORT}/")
+
+async def stop_dashboard():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -1,33 +1,55 @@
+import os
+import csv
 import time
 import random
 import logging
 import uuid
 import string
-from datetime import date
-import certifi
-from pymongo import MongoClient
-from config import MONGO_URI
+from datetime import date, timedelta
+from collections import Counter
+from storage import open_database, run_atomic, DuplicateKeyError, UpdateOne
+from config import MONGO_URI, STORAGE_BACKEND, SQLITE_PATH, WALLET_SCHEMA
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+db = None
 users_collection = None 
 tokens_collection = None       
 transactions_collection = None 
 gift_codes_collection = None
 stats_collection = None
+broadcasts_collection = None
+ledger_collection = None
+reconciliations_collection = None
+leaderboard_collection = None
+leaderboard_meta_collection = None
+referral_stats_collection = None
+portfolio_history_collection = None
+
+storage_backend = os.environ.get("WALLET_STORAGE_BACKEND", STORAGE_BACKEND)
+COMPACT_WALLETS = os.environ.get("WALLET_SCHEMA", WALLET_SCHEMA) == "compact"
+# Where per-symbol quantities live, and the suffix that reaches the quantity inside each entry
+HOLDINGS_FIELD = "wallet.positions" if COMPACT_WALLETS else "wallet.holdings"
+QTY_SUFFIX = ".q" if COMPACT_WALLETS else ""
 
 try:
-    client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
-    db = client.crypto_wallet_bot_db 
+    db = open_database(storage_backend, MONGO_URI, SQLITE_PATH)
     users_collection = db.users
     tokens_collection = db.tokens             
     transactions_collection = db.transactions 
     gift_codes_collection = db.gift_codes
     stats_collection = db.daily_stats
-    logger.info("✅ Successfully connected to Wallet Database.")
+    broadcasts_collection = db.broadcasts
+    ledger_collection = db.ledger
+    reconciliations_collection = db.reconciliations
+    leaderboard_collection = db.leaderboard
+    leaderboard_meta_collection = db.leaderboard_meta
+    referral_stats_collection = db.referral_stats
+    portfolio_history_collection = db.portfolio_history
+    logger.info(f"✅ Successfully connected to Wallet Database ({storage_backend}).")
 except Exception as e:
-    logger.error(f"❌ Failed to connect to MongoDB: {e}")
+    logger.error(f"❌ Failed to connect to {storage_backend} storage: {e}")
 
 # ==========================================
 # 1. USER, STATS & REFERRAL MANAGEMENT
@@ -41,12 +63,20 @@ def record_new_user():
     stats_collection.update_one({"date": today}, {"$inc": {"new_users": 1}}, upsert=True)
 
 def record_first_deposit(user_id):
-    if users_collection is None or stats_collection is None: return
-    user = users_collection.find_one({"user_id": user_id})
-    if user and not user.get("has_deposited", False):
-        users_collection.update_one({"user_id": user_id}, {"$set": {"has_deposited": True}})
-        today = get_today_str()
-        stats_collection.update_one({"date": today}, {"$inc": {"first_deposits": 1}}, upsert=True)
+    record_first_deposits([user_id])
+
+def record_first_deposits(user_ids, session=None):
+    """ Flags first-time depositors among `user_ids` and bumps today's counter once for the lot """
+    if users_collection is None or stats_collection is None or not user_ids: return []
+    query = {"user_id": {"$in": list(set(user_ids))}, "has_deposited": {"$ne": True}}
+    rows = list(users_collection.find(query, {"_id": 0, "user_id": 1, "ancestors": 1}, session=session))
+    if not rows: return []
+    fresh = [u['user_id'] for u in rows]
+    users_collection.update_many({"user_id": {"$in": fresh}}, {"$set": {"has_deposited": True}}, session=session)
+    today = get_today_str()
+    stats_collection.update_one({"date": today}, {"$inc": {"first_deposits": len(fresh)}}, upsert=True, session=session)
+    record_referral_event("depositors", [u.get("ancestors", []) for u in rows], session=session)
+    return fresh
 
 def get_daily_stats():
     if stats_collection is None: return {"new_users": 0, "first_deposits": 0}
@@ -61,25 +91,31 @@ def get_user_data(user_id, referrer_id=None):
     user = users_collection.find_one({"user_id": user_id})
     
     if user is None:
+        ancestors = referral_upline(user_id, referrer_id) if referrer_id and referrer_id != user_id else []
         user = {
             "user_id": user_id,
             "is_banned": False,
             "has_deposited": False,
             "referred_by": referrer_id,
+            "ancestors": ancestors,
             "referral_count": 0,
-            "wallet": {"balance": 0.0, "holdings": {}, "invested_amt": {}, "earned_amt": {}} 
+            "ledger_opened": True,
+            "wallet": new_wallet()
         }
         users_collection.insert_one(user)
         record_new_user()
+        record_referral_event("signups", [ancestors])
         
         if referrer_id and referrer_id != user_id:
-            users_collection.update_one(
-                {"user_id": referrer_id},
-                {"$inc": {"referral_count": 1, "wallet.balance": 50.0}}
-            )
+            apply_balance_change(referrer_id, 50.0, "referral_bonus", ref=user_id, extra_inc={"referral_count": 1})
             
+    elif user.get("is_blocked"):
+        # They came back through /start, so broadcasts can reach them again
+        users_collection.update_one({"user_id": user_id}, {"$set": {"is_blocked": False}})
+        user["is_blocked"] = False
+
     if "wallet" not in user:
-        user["wallet"] = {"balance": 0.0, "holdings": {}, "invested_amt": {}, "earned_amt": {}}
+        user["wallet"] = new_wallet()
         users_collection.update_one({"user_id": user_id}, {"$set": {"wallet": user["wallet"]}})
         
     return user
@@ -113,37 +149,34 @@ def get_all_tokens():
     if tokens_collection is None: return []
     return list(tokens_collection.find({}, {"_id": 0}))
 
-def update_market_prices():
-    if tokens_collection is None: return
-    tokens = list(tokens_collection.find({}))
+MARKET_INTERVAL = 300   # the reversion/noise constants below are tuned for one move per 300 s
+HISTORY_LENGTH = 30
+
+def next_price(current_price, base_price, step=1.0):
+    """ One mean-reversion move. `step` is the tick length as a fraction of MARKET_INTERVAL """
+    deviation = (current_price - base_price) / base_price
+    reversion_force = -deviation * 0.04 * step
+    # Noise scales with sqrt(step) so many short ticks add up to the same volatility as one long one
+    noise = random.uniform(-0.015, 0.015) * step ** 0.5
     
-    for t in tokens:
-        current_price = t['price']
-        base_price = t.get('base_price', current_price) 
-        deviation = (current_price - base_price) / base_price
-        reversion_force = -deviation * 0.04 
-        noise = random.uniform(-0.015, 0.015)
-        
-        change_percent = reversion_force + noise
-        change_percent = max(-0.03, min(0.03, change_percent))
-        
-        new_price = round(current_price * (1 + change_percent), 2)
-        
-        if new_price > base_price * 10: new_price = round(base_price * 10, 2)
-        if new_price < base_price * 0.1: new_price = round(base_price * 0.1, 2)
-        if new_price <= 0.01: new_price = 0.01 
-        
-        update_data = {"price": new_price}
-        if 'base_price' not in t: 
-            update_data['base_price'] = t['price']
-            
-        tokens_collection.update_one(
-            {"symbol": t['symbol']}, 
-            {
-                "$set": update_data,
-                "$push": {"history": {"$each": [new_price], "$slice": -30}}
-            }
-        )
+    limit = 0.03 * step ** 0.5
+    change_percent = max(-limit, min(limit, reversion_force + noise))
+    new_price = current_price * (1 + change_percent)
+    
+    if new_price > base_price * 10: new_price = base_price * 10
+    if new_price < base_price * 0.1: new_price = base_price * 0.1
+    return max(new_price, 0.01)
+
+def save_token_snapshot(snapshot, push_history=False):
+    """ Write-behind for the in-memory market: one unordered bulk write for every token """
+    if tokens_collection is None or not snapshot: return
+    ops = []
+    for t in snapshot:
+        update = {"$set": {"price": t['price'], "base_price": t['base_price'], "updated_at": time.time()}}
+        if push_history:
+            update["$push"] = {"history": {"$each": [t['price']], "$slice": -HISTORY_LENGTH}}
+        ops.append(UpdateOne({"symbol": t['symbol']}, update))
+    tokens_collection.bulk_write(ops, ordered=False)
 
 def get_token_details(symbol):
     if tokens_collection is None: return None
@@ -158,9 +191,10 @@ def update_token_price(symbol, new_price):
                 {"$set": {"price": float(new_price), "base_price": float(new_price)}, "$push": {"history": float(new_price)}}
             )
 
-def get_token_roi_list():
-    if tokens_collection is None: return []
-    tokens = list(tokens_collection.find({}))
+def get_token_roi_list(tokens=None):
+    if tokens is None:
+        if tokens_collection is None: return []
+        tokens = list(tokens_collection.find({}))
     roi_data = []
     
     for t in tokens:
@@ -185,32 +219,119 @@ def get_token_roi_list():
 # ==========================================
 # 3. WALLET FUNCTIONS
 # ==========================================
+def new_wallet():
+    if COMPACT_WALLETS: return {"balance": 0.0, "positions": {}}
+    return {"balance": 0.0, "holdings": {}, "invested_amt": {}, "earned_amt": {}}
+
+def expand_wallet(wallet):
+    """ Presents either schema as the classic balance/holdings/invested_amt/earned_amt maps """
+    if "positions" not in wallet:
+        return {"balance": wallet.get("balance", 0.0), "holdings": wallet.get("holdings", {}),
+                "invested_amt": wallet.get("invested_amt", {}), "earned_amt": wallet.get("earned_amt", {})}
+    positions = wallet.get("positions", {})
+    return {
+        "balance": wallet.get("balance", 0.0),
+        "holdings": {sym: p.get("q", 0) for sym, p in positions.items()},
+        "invested_amt": {sym: p.get("i", 0.0) for sym, p in positions.items()},
+        "earned_amt": {sym: p.get("e", 0.0) for sym, p in positions.items()}
+    }
+
 def get_user_wallet(user_id):
     u = get_user_data(user_id)
-    return u.get("wallet", {"balance": 0.0, "holdings": {}, "invested_amt": {}, "earned_amt": {}})
+    return expand_wallet(u.get("wallet", new_wallet()))
 
-def update_wallet_balance(user_id, amount):
-    if users_collection is not None:
-        users_collection.update_one({"user_id": user_id}, {"$inc": {"wallet.balance": float(amount)}})
+# Projected reads: only the requested fields cross the wire instead of the whole user document
+def _read_wallet(user_id, *fields):
+    if users_collection is None: return None
+    u = users_collection.find_one({"user_id": user_id}, {"_id": 0, **{f: 1 for f in fields}})
+    return u.get("wallet", {}) if u else None
+
+def get_wallet_balance(user_id):
+    wallet = _read_wallet(user_id, "wallet.balance")
+    if wallet is None: return get_user_wallet(user_id)['balance']
+    return wallet.get("balance", 0.0)
+
+def get_wallet_holdings(user_id, symbol=None):
+    """ The holdings map, or just one symbol's quantity when `symbol` is given """
+    path = f"{HOLDINGS_FIELD}.{symbol}{QTY_SUFFIX}" if symbol else HOLDINGS_FIELD
+    wallet = _read_wallet(user_id, path)
+    if wallet is None:
+        holdings = get_user_wallet(user_id)['holdings']
+        return holdings.get(symbol, 0) if symbol else holdings
+    holdings = expand_wallet(wallet)['holdings']
+    return holdings.get(symbol, 0) if symbol else holdings
+
+def get_wallet_summary(user_id):
+    """ Balance and holdings, without the invested/earned bookkeeping maps """
+    wallet = _read_wallet(user_id, "wallet.balance", HOLDINGS_FIELD)
+    if wallet is None: wallet = get_user_wallet(user_id)
+    w = expand_wallet(wallet)
+    return {"balance": w['balance'], "holdings": w['holdings']}
+
+def update_wallet_balance(user_id, amount, reason="adjustment", ref=None):
+    apply_balance_change(user_id, amount, reason, ref)
 
 def trade_token(user_id, symbol, quantity, price, is_buy=True):
     if users_collection is None: return
     cost = float(quantity * price)
     
+    if COMPACT_WALLETS:
+        pos = f"wallet.positions.{symbol}"
+        qty_field, inv_field, earn_field = f"{pos}.q", f"{pos}.i", f"{pos}.e"
+    else:
+        qty_field, inv_field, earn_field = f"wallet.holdings.{symbol}", f"wallet.invested_amt.{symbol}", f"wallet.earned_amt.{symbol}"
+    
     if is_buy:
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$inc": {"wallet.balance": -cost, f"wallet.holdings.{symbol}": quantity, f"wallet.invested_amt.{symbol}": cost}}
-        )
+        apply_balance_change(user_id, -cost, "buy", ref=symbol, extra_inc={qty_field: quantity, inv_field: cost})
     else:
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$inc": {"wallet.balance": cost, f"wallet.holdings.{symbol}": -quantity, f"wallet.earned_amt.{symbol}": cost}}
-        )
+        apply_balance_change(user_id, cost, "sell", ref=symbol, extra_inc={qty_field: -quantity, earn_field: cost})
+
+def migrate_wallet_schema(batch_size=500):
+    """
+    Rewrites wallets stored in the other layout into the configured one with batched bulk
+    writes. Runs at import, before the bot serves updates, so no trade can interleave.
+    """
+    if users_collection is None: return 0
+    if COMPACT_WALLETS:
+        query = {"wallet": {"$exists": True}, "wallet.positions": {"$exists": False}}
+    else:
+        query = {"wallet.positions": {"$exists": True}}
+
+    ops, migrated = [], 0
+    for u in users_collection.find(query, {"_id": 0, "user_id": 1, "wallet": 1}).batch_size(batch_size):
+        w = expand_wallet(u['wallet'])
+        if COMPACT_WALLETS:
+            symbols = set(w['holdings']) | set(w['invested_amt']) | set(w['earned_amt'])
+            positions = {sym: {"q": w['holdings'].get(sym, 0), "i": w['invested_amt'].get(sym, 0.0), "e": w['earned_amt'].get(sym, 0.0)} for sym in symbols}
+            update = {"$set": {"wallet.positions": positions}, "$unset": {"wallet.holdings": "", "wallet.invested_amt": "", "wallet.earned_amt": ""}}
+        else:
+            update = {"$set": {"wallet.holdings": w['holdings'], "wallet.invested_amt": w['invested_amt'], "wallet.earned_amt": w['earned_amt']},
+                      "$unset": {"wallet.positions": ""}}
+        ops.append(UpdateOne({"user_id": u['user_id'], **query}, update))
+        if len(ops) >= batch_size:
+            users_collection.bulk_write(ops, ordered=False)
+            migrated += len(ops)
+            ops = []
+    if ops:
+        users_collection.bulk_write(ops, ordered=False)
+        migrated += len(ops)
+    if migrated: logger.info(f"👛 Converted {migrated} wallets to the {'compact' if COMPACT_WALLETS else 'classic'} layout.")
+    return migrated
 
 # ==========================================
 # 4. TRANSACTION & ADMIN HISTORY
 # ==========================================
+def init_indexes():
+    if users_collection is not None:
+        users_collection.create_index("user_id")
+    if tokens_collection is not None:
+        tokens_collection.create_index("symbol")
+    if transactions_collection is None: return
+    transactions_collection.create_index([("user_id", 1), ("timestamp", -1), ("tx_id", -1)])
+    transactions_collection.create_index([("timestamp", 1), ("tx_id", 1)])
+    transactions_collection.create_index("tx_id")
+    transactions_collection.create_index([("status", 1), ("timestamp", 1), ("tx_id", 1)])
+
 def create_transaction(user_id, tx_type, amount, method, details):
     if transactions_collection is None: return "ERROR"
     tx_id = str(uuid.uuid4())[:8]
@@ -222,29 +343,167 @@ def get_user_transactions(user_id, limit=5):
     if transactions_collection is None: return []
     return list(transactions_collection.find({"user_id": user_id}).sort("timestamp", -1).limit(limit))
 
+def get_user_transactions_page(user_id, limit=5, before=None):
+    """ Keyset page of a user's history, newest first. `before` is the (timestamp, tx_id) of the last row already shown """
+    if transactions_collection is None: return [], None
+    query = {"user_id": user_id}
+    if before:
+        ts, tx_id = before
+        query["$or"] = [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "tx_id": {"$lt": tx_id}}]
+
+    rows = list(transactions_collection.find(query, {"_id": 0}).sort([("timestamp", -1), ("tx_id", -1)]).limit(limit + 1))
+    next_key = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_key = (rows[-1]["timestamp"], rows[-1]["tx_id"])
+    return rows, next_key
+
+EXPORT_FIELDS = ["tx_id", "user_id", "type", "amount", "method", "details", "status", "timestamp"]
+
+def iter_transactions(since=None, until=None, batch_size=500):
+    """ Streams transactions oldest first, one cursor batch in memory at a time """
+    if transactions_collection is None: return
+    query = {}
+    if since is not None or until is not None:
+        query["timestamp"] = {}
+        if since is not None: query["timestamp"]["$gte"] = since
+        if until is not None: query["timestamp"]["$lt"] = until
+    cursor = transactions_collection.find(query, {"_id": 0}).sort([("timestamp", 1), ("tx_id", 1)]).batch_size(batch_size)
+    for tx in cursor:
+        yield tx
+
+def write_transactions_csv(fh, since=None, until=None):
+    """ Writes the transaction stream as CSV rows into an open text file, returns the row count """
+    writer = csv.DictWriter(fh, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    count = 0
+    for tx in iter_transactions(since, until):
+        writer.writerow(tx)
+        count += 1
+    return count
+
+def count_pending_transactions():
+    if transactions_collection is None: return {"deposit": 0, "withdraw": 0}
+    pipeline = [{"$match": {"status": "pending"}}, {"$group": {"_id": "$type", "count": {"$sum": 1}}}]
+    counts = {doc['_id']: doc['count'] for doc in transactions_collection.aggregate(pipeline)}
+    return {"deposit": counts.get("deposit", 0), "withdraw": counts.get("withdraw", 0)}
+
+def get_pending_page(tx_type=None, limit=10, after=None):
+    """ Oldest-first page of the approval queue. `after` is the (timestamp, tx_id) of the last row already shown """
+    if transactions_collection is None: return [], None
+    query = {"status": "pending"}
+    if tx_type: query["type"] = tx_type
+    if after:
+        ts, tx_id = after
+        query["$or"] = [{"timestamp": {"$gt": ts}}, {"timestamp": ts, "tx_id": {"$gt": tx_id}}]
+
+    rows = list(transactions_collection.find(query, {"_id": 0}).sort([("timestamp", 1), ("tx_id", 1)]).limit(limit + 1))
+    next_key = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_key = (rows[-1]["timestamp"], rows[-1]["tx_id"])
+    return rows, next_key
+
+SETTLE_BATCH = 500
+
+def _settle_batch(tx_ids, decision):
+    """
+    Settles the still-pending transactions in `tx_ids` in one transaction: status change,
+    balance credits, ledger entries and first-deposit flags commit together or not at all.
+    """
+    status = "completed" if decision == "ok" else "rejected"
+    # Approved deposits credit the user, rejected withdrawals refund the amount held at request time
+    credit_type, reason = ("deposit", "deposit") if decision == "ok" else ("withdraw", "withdraw_refund")
+
+    def settle(session):
+        rows = list(transactions_collection.find({"tx_id": {"$in": tx_ids}, "status": "pending"}, {"_id": 0}, session=session))
+        if not rows: return []
+        # A concurrent settlement of the same rows conflicts on this write and retries, seeing them settled
+        transactions_collection.update_many(
+            {"tx_id": {"$in": [t['tx_id'] for t in rows]}, "status": "pending"}, {"$set": {"status": status}}, session=session
+        )
+        credits = [t for t in rows if t['type'] == credit_type]
+        if credits:
+            per_user = {}
+            for t in credits:
+                per_user[t['user_id']] = per_user.get(t['user_id'], 0.0) + float(t['amount'])
+            users_collection.bulk_write(
+                [UpdateOne({"user_id": uid}, {"$inc": {"wallet.balance": amt}}) for uid, amt in per_user.items()],
+                ordered=False, session=session
+            )
+            record_ledger_entries([
+                {"user_id": t['user_id'], "amount": t['amount'], "reason": reason, "ref": t['tx_id']} for t in credits
+            ], session=session)
+        if decision == "ok":
+            record_first_deposits([t['user_id'] for t in rows if t['type'] == "deposit"], session=session)
+        for t in rows: t['status'] = status
+        return rows
+    return run_atomic(db, settle)
+
+def settle_transactions(decision, tx_ids=None, up_to=None, tx_type=None, batch_size=SETTLE_BATCH):
+    """
+    Approves ("ok") or rejects ("no") pending transactions in bulk, either an explicit list of
+    tx_ids or the whole queue up to and including the (timestamp, tx_id) key `up_to`.
+    Returns the settled transactions so callers can notify their owners.
+    """
+    if transactions_collection is None or users_collection is None: return []
+    settled = []
+    if tx_ids is not None:
+        tx_ids = list(tx_ids)
+        for i in range(0, len(tx_ids), batch_size):
+            settled += _settle_batch(tx_ids[i:i + batch_size], decision)
+        return settled
+
+    ts, last_id = up_to
+    query = {"status": "pending", "$or": [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "tx_id": {"$lte": last_id}}]}
+    if tx_type: query["type"] = tx_type
+    while True:
+        batch = [t['tx_id'] for t in transactions_collection.find(query, {"_id": 0, "tx_id": 1}).sort([("timestamp", 1), ("tx_id", 1)]).limit(batch_size)]
+        if not batch: break
+        settled += _settle_batch(batch, decision)
+    return settled
+
 def get_transaction(tx_id):
     return transactions_collection.find_one({"tx_id": tx_id})
 
 def update_transaction_status(tx_id, status):
     transactions_collection.update_one({"tx_id": tx_id}, {"$set": {"status": status}})
 
-def get_current_token_stats():
+CLASSIC_WALLET_MAPS = {"q": "$wallet.holdings", "i": "$wallet.invested_amt", "e": "$wallet.earned_amt"}
+
+def sum_wallets_by_symbol(outputs):
+    """
+    Per-symbol totals across every wallet. `outputs` maps result names to position fields
+    (q = quantity, i = invested, e = earned). Compact wallets need a single pass for all of
+    them; classic wallets keep each in its own map and need one pass per field.
+    """
+    if users_collection is None: return {}
+    if COMPACT_WALLETS:
+        pipelines = [(outputs, "$wallet.positions", lambda f: f"$arr.v.{f}")]
+    else:
+        pipelines = [({name: f}, CLASSIC_WALLET_MAPS[f], lambda f: "$arr.v") for name, f in outputs.items()]
+
+    totals = {}
+    for fields, source, value in pipelines:
+        pipe = [
+            {"$project": {"arr": {"$objectToArray": {"$ifNull": [source, {}]}}}},
+            {"$unwind": "$arr"},
+            {"$group": {"_id": "$arr.k", **{name: {"$sum": value(f)} for name, f in fields.items()}}}
+        ]
+        for doc in users_collection.aggregate(pipe):
+            totals.setdefault(doc['_id'], {}).update({name: doc[name] for name in fields})
+    return totals
+
+def get_current_token_stats(prices=None):
     """ Calculates current total value of tokens held by all users at THIS exact moment """
     if users_collection is None or tokens_collection is None: return []
     
-    tokens = {t['symbol']: t['price'] for t in tokens_collection.find({})}
-    
-    pipeline = [
-        {"$project": {"arr": {"$objectToArray": {"$ifNull": ["$wallet.holdings", {}]}}}},
-        {"$unwind": "$arr"},
-        {"$group": {"_id": "$arr.k", "total_held": {"$sum": "$arr.v"}}}
-    ]
+    tokens = prices or {t['symbol']: t['price'] for t in tokens_collection.find({})}
     
-    holdings_data = list(users_collection.aggregate(pipeline))
+    holdings_data = sum_wallets_by_symbol({"total_held": "q"})
     
     stats = []
-    for h in holdings_data:
-        sym = h['_id']
+    for sym, h in holdings_data.items():
         qty = h['total_held']
         price = tokens.get(sym, 0)
         current_value = qty * price
@@ -255,29 +514,20 @@ def get_current_token_stats():
     stats.sort(key=lambda x: x['current_value'], reverse=True)
     return stats
 
-def get_platform_profit_by_token():
+def get_platform_profit_by_token(prices=None):
     """ Calculates exact real-time net profit users are making per token """
     if users_collection is None or tokens_collection is None: return []
     
-    tokens = {t['symbol']: t['price'] for t in tokens_collection.find({})}
+    tokens = prices or {t['symbol']: t['price'] for t in tokens_collection.find({})}
     
-    def get_sum(field_path):
-        pipe = [
-            {"$project": {"arr": {"$objectToArray": {"$ifNull": [field_path, {}]}}}},
-            {"$unwind": "$arr"},
-            {"$group": {"_id": "$arr.k", "total": {"$sum": "$arr.v"}}}
-        ]
-        return {doc['_id']: doc['total'] for doc in users_collection.aggregate(pipe)}
-        
-    holdings = get_sum("$wallet.holdings")
-    invested = get_sum("$wallet.invested_amt")
-    earned = get_sum("$wallet.earned_amt")
+    totals = sum_wallets_by_symbol({"qty": "q", "inv": "i", "ern": "e"})
     
     stats = []
     for sym, current_price in tokens.items():
-        qty = holdings.get(sym, 0)
-        inv = invested.get(sym, 0)
-        ern = earned.get(sym, 0)
+        t = totals.get(sym, {})
+        qty = t.get("qty", 0)
+        inv = t.get("inv", 0)
+        ern = t.get("ern", 0)
         
         current_value = qty * current_price
         net_profit = (current_value + ern) - inv
@@ -303,10 +553,406 @@ def generate_gift_code(amount):
 
 def redeem_gift_code(user_id, code):
     if gift_codes_collection is None: return False, 0
-    gc = gift_codes_collection.find_one({"code": code, "used": False})
+    # Claim and mark used in one write so two users can't redeem the same code
+    gc = gift_codes_collection.find_one_and_update({"code": code, "used": False}, {"$set": {"used": True, "used_by": user_id}})
     if not gc: return False, 0
-    gift_codes_collection.update_one({"code": code}, {"$set": {"used": True, "used_by": user_id}})
-    update_wallet_balance(user_id, gc["amount"])
+    update_wallet_balance(user_id, gc["amount"], "gift_code", ref=code)
     return True, gc["amount"]
 
+# ==========================================
+# 6. BROADCASTS
+# ==========================================
+def create_broadcast(text):
+    if broadcasts_collection is None: return None
+    broadcast_id = str(uuid.uuid4())[:8]
+    broadcasts_collection.insert_one({
+        "broadcast_id": broadcast_id, "text": text, "status": "running", "last_user_id": None,
+        "sent": 0, "failed": 0, "blocked": 0, "created_at": time.time(), "updated_at": time.time()
+    })
+    return broadcast_id
+
+def get_broadcast(broadcast_id):
+    if broadcasts_collection is None: return None
+    return broadcasts_collection.find_one({"broadcast_id": broadcast_id}, {"_id": 0})
+
+def get_running_broadcasts():
+    if broadcasts_collection is None: return []
+    return list(broadcasts_collection.find({"status": "running"}, {"_id": 0}))
+
+def set_broadcast_status(broadcast_id, status):
+    if broadcasts_collection is None: return
+    broadcasts_collection.update_one({"broadcast_id": broadcast_id}, {"$set": {"status": status, "updated_at": time.time()}})
+
+def checkpoint_broadcast(broadcast_id, last_user_id, sent, failed, blocked):
+    """ Records the last user_id whose batch fully went out, so a restart resumes after it """
+    if broadcasts_collection is None: return
+    broadcasts_collection.update_one(
+        {"broadcast_id": broadcast_id},
+        {"$set": {"last_user_id": last_user_id, "updated_at": time.time()}, "$inc": {"sent": sent, "failed": failed, "blocked": blocked}}
+    )
+
+def iter_broadcast_targets(after_user_id=None, batch_size=500):
+    """ Streams reachable user_ids in ascending order, starting after the checkpoint """
+    if users_collection is None: return
+    query = {"is_blocked": {"$ne": True}}
+    if after_user_id is not None:
+        query["user_id"] = {"$gt": after_user_id}
+    cursor = users_collection.find(query, {"_id": 0, "user_id": 1}).sort("user_id", 1).batch_size(batch_size)
+    for u in cursor:
+        yield u["user_id"]
+
+def mark_users_blocked(user_ids):
+    if users_collection is None or not user_ids: return
+    users_collection.update_many({"user_id": {"$in": list(user_ids)}}, {"$set": {"is_blocked": True}})
+
+# ==========================================
+# 7. LEDGER & RECONCILIATION
+# ==========================================
+RECONCILE_TOLERANCE = 0.01
+RECONCILE_MAX_FLAGGED = 100
+
+def init_ledger_indexes():
+    if ledger_collection is None: return
+    ledger_collection.create_index("entry_id", unique=True)
+    ledger_collection.create_index([("user_id", 1), ("ts", 1)])
+
+def record_ledger_entry(user_id, amount, reason, ref=None, entry_id=None, session=None):
+    """ Appends one immutable balance movement. Entries are never updated or deleted """
+    if ledger_collection is None: return
+    entry = {"entry_id": entry_id or uuid.uuid4().hex, "user_id": user_id, "amount": float(amount), "reason": reason, "ref": ref, "ts": time.time()}
+    try:
+        ledger_collection.insert_one(entry, session=session)
+    except DuplicateKeyError:
+        # Only reachable with a deterministic entry_id, which is never used inside a transaction
+        pass
+
+def record_ledger_entries(entries, session=None):
+    """ Bulk variant of record_ledger_entry for batch settlements """
+    if ledger_collection is None or not entries: return
+    now = time.time()
+    ledger_collection.insert_many([
+        {"entry_id": uuid.uuid4().hex, "user_id": e['user_id'], "amount": float(e['amount']), "reason": e['reason'], "ref": e.get('ref'), "ts": now}
+        for e in entries
+    ], ordered=False, session=session)
+
+def apply_balance_change(user_id, amount, reason, ref=None, extra_inc=None):
+    """ Moves wallet.balance (plus any extra counters) and appends the matching ledger entry in one transaction """
+    if users_collection is None: return False
+    inc = {"wallet.balance": float(amount)}
+    inc.update(extra_inc or {})
+
+    def move(session):
+        res = users_collection.update_one({"user_id": user_id}, {"$inc": inc}, session=session)
+        if not res.matched_count: return False
+        record_ledger_entry(user_id, amount, reason, ref, session=session)
+        return True
+    return run_atomic(db, move)
+
+def open_legacy_ledgers(batch_size=500):
+    """ Gives users created before the ledger an opening entry equal to their balance at that time """
+    if users_collection is None or ledger_collection is None: return 0
+    cursor = users_collection.find({"ledger_opened": {"$ne": True}}, {"_id": 0, "user_id": 1, "wallet.balance": 1}).batch_size(batch_size)
+    opened = 0
+    for u in cursor:
+        balance = u.get("wallet", {}).get("balance", 0.0)
+        # Deterministic id keeps this idempotent if we crash between the two writes
+        record_ledger_entry(u["user_id"], balance, "opening_balance", entry_id=f"open_{u['user_id']}")
+        users_collection.update_one({"user_id": u["user_id"]}, {"$set": {"ledger_opened": True}})
+        opened += 1
+    if opened: logger.info(f"📒 Opened ledgers for {opened} existing users.")
+    return opened
+
+def _ledger_totals(user_ids):
+    pipeline = [
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$group": {"_id": "$user_id", "total": {"$sum": "$amount"}}}
+    ]
+    return {doc["_id"]: doc["total"] for doc in ledger_collection.aggregate(pipeline)}
+
+def _balances(user_ids):
+    return {u["user_id"]: u.get("wallet", {}).get("balance", 0.0)
+            for u in users_collection.find({"user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "wallet.balance": 1})}
+
+def reconcile_ledger(batch_size=500):
+    """
+    Streams users in user_id order and compares each batch's balances against one grouped
+    ledger aggregation. Memory stays at one batch plus a capped list of flagged users.
+    """
+    if users_collection is None or ledger_collection is None: return None
+    run = {"run_id": str(uuid.uuid4())[:8], "started_at": time.time(), "checked": 0, "mismatch_count": 0, "mismatches": []}
+    cursor = users_collection.find({}, {"_id": 0, "user_id": 1, "wallet.balance": 1}).sort("user_id", 1).batch_size(batch_size)
+
+    batch = []
+    def check(batch):
+        ids = [u["user_id"] for u in batch]
+        totals = _ledger_totals(ids)
+        suspects = [u["user_id"] for u in batch
+                    if abs(u.get("wallet", {}).get("balance", 0.0) - totals.get(u["user_id"], 0.0)) > RECONCILE_TOLERANCE]
+        if suspects:
+            # Re-read both sides so a trade landing mid-scan isn't reported as drift
+            balances, totals = _balances(suspects), _ledger_totals(suspects)
+            for uid in suspects:
+                diff = balances.get(uid, 0.0) - totals.get(uid, 0.0)
+                if abs(diff) > RECONCILE_TOLERANCE:
+                    run["mismatch_count"] += 1
+                    if len(run["mismatches"]) < RECONCILE_MAX_FLAGGED:
+                        run["mismatches"].append({"user_id": uid, "balance": balances.get(uid, 0.0), "ledger": totals.get(uid, 0.0), "diff": diff})
+        run["checked"] += len(batch)
+
+    for u in cursor:
+        batch.append(u)
+        if len(batch) >= batch_size:
+            check(batch)
+            batch = []
+    if batch: check(batch)
+
+    run["finished_at"] = time.time()
+    if reconciliations_collection is not None:
+        reconciliations_collection.insert_one(dict(run))
+    return run
+
+# ==========================================
+# 8. NET-WORTH LEADERBOARD
+# ==========================================
+# Valuation happens entirely inside the database: holdings are unwound, joined to the
+# tokens collection for their price, and summed back per user, sorted by net worth.
+NET_WORTH_PIPELINE = [
+    {"$project": {
+        "_id": 0, "user_id": 1,
+        "balance": {"$ifNull": ["$wallet.balance", 0]},
+        "h": {"$objectToArray": {"$ifNull": [f"${HOLDINGS_FIELD}", {}]}}
+    }},
+    {"$unwind": {"path": "$h", "preserveNullAndEmptyArrays": True}},
+    {"$lookup": {"from": "tokens", "localField": "h.k", "foreignField": "symbol", "as": "tok"}},
+    {"$group": {
+        "_id": "$user_id",
+        "balance": {"$first": "$balance"},
+        "assets": {"$sum": {"$multiply": [{"$ifNull": [f"$h.v{QTY_SUFFIX}", 0]}, {"$ifNull": [{"$arrayElemAt": ["$tok.price", 0]}, 0]}]}}
+    }},
+    {"$project": {"_id": 0, "user_id": "$_id", "balance": 1, "assets": 1, "net_worth": {"$add": ["$balance", "$assets"]}}},
+    {"$match": {"net_worth": {"$gt": 0}}},
+    {"$sort": {"net_worth": -1, "user_id": 1}}
+]
+
+_leaderboard_snapshot = None
+
+def init_leaderboard_indexes():
+    if leaderboard_collection is None: return
+    leaderboard_collection.create_index([("snapshot", 1), ("rank", 1)])
+    leaderboard_collection.create_index([("snapshot", 1), ("user_id", 1)])
+
+def build_leaderboard(batch_size=1000):
+    """
+    Writes a new ranked snapshot in batches while streaming the valuation cursor, then
+    flips the current-snapshot pointer and drops the old one. Readers never see a half-built board.
+    """
+    global _leaderboard_snapshot
+    if users_collection is None or leaderboard_collection is None: return 0
+    snapshot = str(uuid.uuid4())[:8]
+    computed_at = time.time()
+    rank = 0
+    batch = []
+    for row in users_collection.aggregate(NET_WORTH_PIPELINE, allowDiskUse=True):
+        rank += 1
+        batch.append({"snapshot": snapshot, "rank": rank, "user_id": row['user_id'], "net_worth": row['net_worth'],
+                      "balance": row['balance'], "assets": row['assets']})
+        if len(batch) >= batch_size:
+            leaderboard_collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch: leaderboard_collection.insert_many(batch, ordered=False)
+
+    leaderboard_meta_collection.update_one(
+        {"name": "current"}, {"$set": {"snapshot": snapshot, "computed_at": computed_at, "ranked": rank}}, upsert=True
+    )
+    _leaderboard_snapshot = {"snapshot": snapshot, "computed_at": computed_at, "ranked": rank}
+    leaderboard_collection.delete_many({"snapshot": {"$ne": snapshot}})
+    return rank
+
+def get_leaderboard_meta():
+    if _leaderboard_snapshot is not None: return _leaderboard_snapshot
+    if leaderboard_meta_collection is None: return None
+    return leaderboard_meta_collection.find_one({"name": "current"}, {"_id": 0})
+
+def get_leaderboard(limit=10):
+    meta = get_leaderboard_meta()
+    if not meta: return None, []
+    rows = list(leaderboard_collection.find({"snapshot": meta['snapshot'], "rank": {"$lte": limit}}, {"_id": 0}).sort("rank", 1))
+    return meta, rows
+
+def get_user_rank(user_id):
+    meta = get_leaderboard_meta()
+    if not meta: return None
+    return leaderboard_collection.find_one({"snapshot": meta['snapshot'], "user_id": user_id}, {"_id": 0})
+
+# ==========================================
+# 9. REFERRAL TREE
+# ==========================================
+# Every user stores their upline (`ancestors`, direct referrer first) and every referrer has
+# one referral_stats doc with per-level counters, both kept current on signup and on first
+# deposit. /invite reads a single doc instead of walking the tree.
+REFERRAL_LEVELS = 3
+
+def init_referral_indexes():
+    if referral_stats_collection is None: return
+    referral_stats_collection.create_index("user_id", unique=True)
+
+def referral_upline(user_id, referrer_id):
+    """
+    Ancestors for a new signup: the referrer, then the referrer's own upline, REFERRAL_LEVELS
+    deep. Unknown referrers get no bonus, so they get no upline either.
+    """
+    parent = users_collection.find_one({"user_id": referrer_id}, {"_id": 0, "ancestors": 1})
+    if parent is None: return []
+    chain = [referrer_id] + parent.get("ancestors", [])
+    # Never let a user count themselves, whatever stale ids the referrer's chain holds
+    if user_id in chain: chain = chain[:chain.index(user_id)]
+    return chain[:REFERRAL_LEVELS]
+
+def record_referral_event(field, uplines, session=None):
+    """ Bumps `field` ("signups" or "depositors") at the right level for every ancestor in `uplines` """
+    if referral_stats_collection is None: return
+    counts = Counter()
+    for ancestors in uplines:
+        for level, ancestor in enumerate(ancestors[:REFERRAL_LEVELS], start=1):
+            counts[(ancestor, level)] += 1
+    if not counts: return
+    now = time.time()
+    ops = [UpdateOne({"user_id": ancestor}, {"$inc": {f"{field}.l{level}": n}, "$max": {"depth": level}, "$set": {"updated_at": now}}, upsert=True)
+           for (ancestor, level), n in counts.items()]
+    referral_stats_collection.bulk_write(ops, ordered=False, session=session)
+
+def get_referral_stats(user_id):
+    if referral_stats_collection is None: return {}
+    return referral_stats_collection.find_one({"user_id": user_id}, {"_id": 0}) or {}
+
+def build_referral_tree(batch_size=1000):
+    """
+    One-off backfill for users created before uplines were stored: derives every upline
+    from referred_by, then rebuilds all referral_stats from scratch. Skipped once every
+    user has `ancestors`.
+    """
+    if users_collection is None or referral_stats_collection is None: return 0
+    if users_collection.count_documents({"ancestors": {"$exists": False}}) == 0: return 0
+
+    parents, known, deposited = {}, set(), set()
+    for u in users_collection.find({}, {"_id": 0, "user_id": 1, "referred_by": 1, "has_deposited": 1}).batch_size(batch_size):
+        known.add(u['user_id'])
+        if u.get("referred_by") and u['referred_by'] != u['user_id']:
+            parents[u['user_id']] = u['referred_by']
+        if u.get("has_deposited"): deposited.add(u['user_id'])
+    parents = {uid: ref for uid, ref in parents.items() if ref in known}
+
+    def upline(start):
+        chain, uid = [], start
+        while uid in parents and len(chain) < REFERRAL_LEVELS:
+            uid = parents[uid]
+            if uid == start or uid in chain: break
+            chain.append(uid)
+        return chain
+
+    ops, counts = [], {"signups": Counter(), "depositors": Counter()}
+    for uid in list(parents) + [u for u in deposited if u not in parents]:
+        ancestors = upline(uid)
+        for level, ancestor in enumerate(ancestors, start=1):
+            counts["signups"][(ancestor, level)] += 1
+            if uid in deposited: counts["depositors"][(ancestor, level)] += 1
+        ops.append(UpdateOne({"user_id": uid}, {"$set": {"ancestors": ancestors}}))
+        if len(ops) >= batch_size:
+            users_collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: users_collection.bulk_write(ops, ordered=False)
+    users_collection.update_many({"ancestors": {"$exists": False}}, {"$set": {"ancestors": []}})
+
+    docs, now = {}, time.time()
+    for field, counter in counts.items():
+        for (ancestor, level), n in counter.items():
+            doc = docs.setdefault(ancestor, {"user_id": ancestor, "signups": {}, "depositors": {}, "depth": 0, "updated_at": now})
+            doc[field][f"l{level}"] = n
+            doc["depth"] = max(doc["depth"], level)
+    referral_stats_collection.delete_many({})
+    rows = list(docs.values())
+    for i in range(0, len(rows), batch_size):
+        referral_stats_collection.insert_many(rows[i:i + batch_size], ordered=False)
+    logger.info(f"🌳 Rebuilt referral stats for {len(rows)} referrers.")
+    return len(rows)
+
+# ==========================================
+# 10. PORTFOLIO HISTORY
+# ==========================================
+# Bucketed time series: one doc per user per day holding [ts, net_worth, pnl] points. A point
+# is only written when the value moved by PORTFOLIO_MIN_CHANGE or PORTFOLIO_MAX_GAP has
+# passed, so quiet portfolios are downsampled to roughly one point per gap.
+PORTFOLIO_MIN_CHANGE = 0.005    # relative net-worth move that forces a point
+PORTFOLIO_MAX_GAP = 3600        # seconds, at least one point this often while holding tokens
+PORTFOLIO_DAYS = 30
+
+_portfolio_last = {}    # user_id -> (ts, net_worth) of the last stored point
+_portfolio_pruned = None
+
+def init_portfolio_indexes():
+    if portfolio_history_collection is None: return
+    portfolio_history_collection.create_index([("user_id", 1), ("day", 1)], unique=True)
+    portfolio_history_collection.create_index("day")
+
+def value_wallet(wallet, prices):
+    """ (net_worth, pnl) at `prices`; pnl is holdings value plus sale proceeds minus what was invested """
+    w = expand_wallet(wallet)
+    assets = sum(qty * prices.get(sym, 0) for sym, qty in w['holdings'].items())
+    pnl = assets + sum(w['earned_amt'].values()) - sum(w['invested_amt'].values())
+    return round(w['balance'] + assets, 2), round(pnl, 2)
+
+def record_portfolio_snapshots(prices, batch_size=500):
+    """ Values every wallet that holds tokens and appends a point where it is due. Returns points written """
+    global _portfolio_pruned
+    if users_collection is None or portfolio_history_collection is None or not prices: return 0
+    now = int(time.time())
+    today = get_today_str()
+    query = {HOLDINGS_FIELD: {"$exists": True, "$ne": {}}}
+
+    ops, stored = [], {}
+
+    def flush():
+        portfolio_history_collection.bulk_write(ops, ordered=False)
+        # Only points that were actually written may suppress the next ones
+        _portfolio_last.update(stored)
+        written = len(ops)
+        ops.clear()
+        stored.clear()
+        return written
+
+    written = 0
+    for u in users_collection.find(query, {"_id": 0, "user_id": 1, "wallet": 1}).batch_size(batch_size):
+        if not any(expand_wallet(u['wallet'])['holdings'].values()): continue
+        net_worth, pnl = value_wallet(u['wallet'], prices)
+        last = _portfolio_last.get(u['user_id'])
+        if last and now - last[0] < PORTFOLIO_MAX_GAP and abs(net_worth - last[1]) <= abs(last[1]) * PORTFOLIO_MIN_CHANGE:
+            continue
+        stored[u['user_id']] = (now, net_worth)
+        ops.append(UpdateOne({"user_id": u['user_id'], "day": today}, {"$push": {"points": [now, net_worth, pnl]}}, upsert=True))
+        if len(ops) >= batch_size: written += flush()
+    if ops: written += flush()
+
+    if _portfolio_pruned != today:
+        cutoff = (date.today() - timedelta(days=PORTFOLIO_DAYS)).isoformat()
+        portfolio_history_collection.delete_many({"day": {"$lt": cutoff}})
+        _portfolio_pruned = today
+    return written
+
+def get_portfolio_history(user_id, days=7):
+    """ [ts, net_worth, pnl] points for the last `days` days, oldest first """
+    if portfolio_history_collection is None: return []
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    points = []
+    for bucket in portfolio_history_collection.find({"user_id": user_id, "day": {"$gte": since}}, {"_id": 0, "points": 1}).sort("day", 1):
+        points.extend(bucket.get("points", []))
+    return points
+
 init_tokens()
+init_indexes()
+init_ledger_indexes()
+init_leaderboard_indexes()
+init_referral_indexes()
+init_portfolio_indexes()
+open_legacy_ledgers()
+migrate_wallet_schema()
+build_referral_tree()
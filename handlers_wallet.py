@@ -1,22 +1,30 @@
 import io
+import time
+import asyncio
 import logging
+import tempfile
+from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes, ConversationHandler
 from database import (
-    get_user_wallet, get_all_tokens, update_wallet_balance, 
+    get_wallet_balance, get_wallet_holdings, get_wallet_summary, update_wallet_balance, 
     trade_token, create_transaction, get_user_transactions, 
-    update_transaction_status, get_transaction, get_user_data,
-    update_token_price, users_collection, get_token_details,
-    record_first_deposit, get_daily_stats, generate_gift_code, 
-    redeem_gift_code, get_current_token_stats, get_token_roi_list,
-    get_platform_profit_by_token
+    get_transaction, get_user_data,
+    users_collection, get_daily_stats, generate_gift_code, 
+    redeem_gift_code, get_current_token_stats, get_platform_profit_by_token, get_user_transactions_page, write_transactions_csv,
+    create_broadcast, get_broadcast, get_running_broadcasts, set_broadcast_status,
+    reconcile_ledger, get_leaderboard, get_user_rank, get_pending_page, settle_transactions,
+    count_pending_transactions, get_referral_stats, REFERRAL_LEVELS, get_portfolio_history
 )
+from market import get_all_tokens, get_token_details, get_token_roi_list, get_price_map, update_token_price
+from notifier import broadcast_task, notify_users
+from profiler import profiler, DEFAULT_PROFILE_SECONDS, MAX_PROFILE_SECONDS
 from config import ADMIN_ID, PAYMENT_IMAGE_URL
 
 try:
-    import matplotlib
-    matplotlib.use('Agg') 
-    import matplotlib.pyplot as plt
+    # Figure objects carry their own Agg canvas, no pyplot global state, so charts can render on any thread
+    from matplotlib.figure import Figure
     HAS_MATPLOTLIB = True
 except ImportError:
     HAS_MATPLOTLIB = False
@@ -25,21 +33,26 @@ except ImportError:
 DEP_AMOUNT, DEP_METHOD, DEP_UTR = range(10, 13)
 WD_AMOUNT, WD_METHOD, WD_DETAILS = range(20, 23)
 TRADE_AMOUNT = 30 
+HISTORY_PAGE_SIZE = 5
+PENDING_PAGE_SIZE = 8
+PENDING_DETAILS_LEN = 40   # details are free-form user text, keep the page well under Telegram's 4096 chars
+PERFORMANCE_DAYS = 7
+CHART_CACHE_SIZE = 500
 
-def generate_chart_image(symbol, history):
+def generate_chart_image(symbol, history, title=None, ylabel="Price (INR)"):
     if not HAS_MATPLOTLIB: return None
     try:
-        fig, ax = plt.subplots(figsize=(6, 3), dpi=100)
+        fig = Figure(figsize=(6, 3), dpi=100)
+        ax = fig.subplots()
         color = '#00ff00' if len(history) > 1 and history[-1] >= history[0] else '#ff0000'
-        ax.plot(history, marker='o', linestyle='-', color=color, linewidth=2, markersize=4)
-        ax.set_title(f"{symbol} Price History")
-        ax.set_ylabel("Price (INR)")
+        ax.plot(history, marker='o' if len(history) <= 60 else None, linestyle='-', color=color, linewidth=2, markersize=4)
+        ax.set_title(title or f"{symbol} Price History")
+        ax.set_ylabel(ylabel)
         ax.grid(True, linestyle='--', alpha=0.3)
         
         buf = io.BytesIO()
         fig.savefig(buf, format='png', bbox_inches='tight')
         buf.seek(0)
-        plt.close(fig)
         return buf
     except Exception as e:
         print(f"Chart Error: {e}")
@@ -50,7 +63,7 @@ def generate_chart_image(symbol, history):
 # ==========================================
 async def wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    wallet = get_user_wallet(uid)
+    wallet = get_wallet_summary(uid)
     bal = wallet['balance']
     
     tokens = get_all_tokens()
@@ -87,7 +100,7 @@ async def wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     kb = [
         [InlineKeyboardButton("➕ Deposit", callback_data="start_deposit"), InlineKeyboardButton("➖ Withdraw", callback_data="start_withdraw")],
-        [InlineKeyboardButton("📈 Token Market", callback_data="wallet_tokens")],
+        [InlineKeyboardButton("📈 Token Market", callback_data="wallet_tokens"), InlineKeyboardButton("📜 History", callback_data="hist_top")],
         [InlineKeyboardButton("🔙 Home", callback_data="back_home")]
     ]
     
@@ -101,6 +114,45 @@ async def wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
     return ConversationHandler.END
 
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    q = update.callback_query
+    before = None
+    if q:
+        await q.answer()
+        if q.data != "hist_top":
+            _, ts, tx_id = q.data.split("_", 2)
+            before = (float(ts), tx_id)
+
+    txs, next_key = get_user_transactions_page(uid, limit=HISTORY_PAGE_SIZE, before=before)
+    lines = ""
+    for tx in txs:
+        icon = "📥" if tx['type'] == 'deposit' else "📤"
+        when = datetime.fromtimestamp(tx['timestamp']).strftime("%d %b %H:%M")
+        lines += f"{icon} **{tx['type'].title()}:** ₹{tx['amount']} ({tx['status'].title()}) - {when}\n"
+
+    msg = (
+        f"📜 **TRANSACTION HISTORY**\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"{lines if lines else 'No transactions found.'}"
+    )
+
+    nav = []
+    if before: nav.append(InlineKeyboardButton("⏮ Latest", callback_data="hist_top"))
+    if next_key: nav.append(InlineKeyboardButton("⬅️ Older", callback_data=f"hist_{next_key[0]!r}_{next_key[1]}"))
+    kb = [nav] if nav else []
+    kb.append([InlineKeyboardButton("🔙 Back to Wallet", callback_data="wallet_main")])
+
+    if q:
+        if q.message.photo:
+            await q.message.delete()
+            await context.bot.send_message(uid, msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
+        else:
+            await q.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
+    else:
+        await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
+    return ConversationHandler.END
+
 # ==========================================
 # 2. TOKEN MARKET & CHARTS
 # ==========================================
@@ -165,13 +217,13 @@ async def ask_trade_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     token = get_token_details(sym)
     uid = q.from_user.id
-    wallet = get_user_wallet(uid)
     
     if action == "buy":
-        max_buy = int(wallet['balance'] // token['price'])
-        msg = f"🟢 **BUY {sym}**\n💰 Price: ₹{token['price']}\n💵 Balance: ₹{wallet['balance']:.2f}\n🛒 Max Buy: **{max_buy}**\n\n🔢 **Type Amount to Buy (e.g. 5):**"
+        bal = get_wallet_balance(uid)
+        max_buy = int(bal // token['price'])
+        msg = f"🟢 **BUY {sym}**\n💰 Price: ₹{token['price']}\n💵 Balance: ₹{bal:.2f}\n🛒 Max Buy: **{max_buy}**\n\n🔢 **Type Amount to Buy (e.g. 5):**"
     else: 
-        owned = wallet.get('holdings', {}).get(sym, 0)
+        owned = get_wallet_holdings(uid, sym)
         msg = f"🔴 **SELL {sym}**\n💰 Price: ₹{token['price']}\n🎒 You own: **{owned}**\n\n🔢 **Type Amount to Sell:**"
 
     if q.message.photo:
@@ -194,18 +246,17 @@ async def execute_trade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = context.user_data.get('trade_action')
     sym = context.user_data.get('trade_symbol')
     token = get_token_details(sym)
-    wallet = get_user_wallet(uid)
     
     if action == "buy":
         cost = qty * token['price']
-        if wallet['balance'] >= cost:
+        if get_wallet_balance(uid) >= cost:
             trade_token(uid, sym, qty, token['price'], is_buy=True)
             await update.message.reply_text(f"✅ **BOUGHT!**\n➕ {qty} {sym}\n➖ ₹{cost:.2f}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Chart", callback_data=f"view_chart_{sym}")]]))
         else:
             await update.message.reply_text("❌ **Insufficient Funds.**", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Chart", callback_data=f"view_chart_{sym}")]]))
 
     elif action == "sell":
-        owned = wallet.get('holdings', {}).get(sym, 0)
+        owned = get_wallet_holdings(uid, sym)
         if owned >= qty:
             earnings = qty * token['price']
             trade_token(uid, sym, qty, token['price'], is_buy=False)
@@ -275,7 +326,7 @@ async def start_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     uid = q.from_user.id
-    bal = get_user_wallet(uid)['balance']
+    bal = get_wallet_balance(uid)
     
     if bal < 100:
         msg, kb = "❌ Min withdrawal is ₹100.", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="wallet_main")]])
@@ -307,10 +358,10 @@ async def ask_withdraw_details(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def process_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     details, uid, amt = update.message.text, update.effective_user.id, context.user_data['wd_amount']
-    if get_user_wallet(uid)['balance'] < amt: return ConversationHandler.END
+    if get_wallet_balance(uid) < amt: return ConversationHandler.END
     
-    update_wallet_balance(uid, -amt)
     tx_id = create_transaction(uid, "withdraw", amt, context.user_data['wd_method'], details)
+    update_wallet_balance(uid, -amt, "withdraw", ref=tx_id)
     
     kb_admin = InlineKeyboardMarkup([[InlineKeyboardButton("Approve", callback_data=f"adm_wd_ok_{tx_id}"), InlineKeyboardButton("Reject", callback_data=f"adm_wd_no_{tx_id}")]])
     await context.bot.send_message(ADMIN_ID, f"📤 **WITHDRAW**\nUser: {uid}\nAmt: ₹{amt}\nDet: {details}", reply_markup=kb_admin)
@@ -320,6 +371,12 @@ async def process_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ==========================================
 # 6. ADMIN & NEW FEATURE HANDLERS
 # ==========================================
+def settlement_message(tx, decision):
+    amt = tx['amount']
+    if tx['type'] == "deposit":
+        return f"✅ Deposit ₹{amt} Approved" if decision == "ok" else f"❌ Deposit ₹{amt} Rejected"
+    return f"✅ Withdraw ₹{amt} Sent" if decision == "ok" else f"❌ Withdraw ₹{amt} Rejected (Refunded)"
+
 async def admin_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     parts = q.data.split("_")
@@ -327,26 +384,96 @@ async def admin_payment_handler(update: Update, context: ContextTypes.DEFAULT_TY
     tx = get_transaction(tx_id)
     if not tx or tx['status'] != 'pending': return await q.answer("❌ Already processed.", show_alert=True)
 
-    uid, amt = tx['user_id'], tx['amount']
-    if action == "dep": 
-        if decision == "ok":
-            update_wallet_balance(uid, amt)
-            update_transaction_status(tx_id, "completed")
-            record_first_deposit(uid) 
-            await context.bot.send_message(uid, f"✅ Deposit ₹{amt} Approved")
-        else:
-            update_transaction_status(tx_id, "rejected")
-            await context.bot.send_message(uid, f"❌ Deposit ₹{amt} Rejected")
-            
-    elif action == "wd":
-        if decision == "ok":
-            update_transaction_status(tx_id, "completed")
-            await context.bot.send_message(uid, f"✅ Withdraw ₹{amt} Sent")
-        else:
-            update_wallet_balance(uid, amt); update_transaction_status(tx_id, "rejected")
-            await context.bot.send_message(uid, f"❌ Withdraw ₹{amt} Rejected (Refunded)")
+    settled = settle_transactions(decision, tx_ids=[tx_id])
+    if not settled: return await q.answer("❌ Already processed.", show_alert=True)
+    await context.bot.send_message(tx['user_id'], settlement_message(tx, decision))
     await q.edit_message_text(f"Processed: {action} {decision}")
 
+# --- BATCHED APPROVAL QUEUE ---
+def render_pending_queue(context):
+    ud = context.user_data
+    tx_type = ud.get('pq_type')
+    selected = ud.setdefault('pq_selected', set())
+    rows, next_key = get_pending_page(tx_type, PENDING_PAGE_SIZE, ud.get('pq_page'))
+    ud['pq_next'] = next_key
+    ud['pq_last'] = (rows[-1]['timestamp'], rows[-1]['tx_id']) if rows else None
+    counts = count_pending_transactions()
+
+    msg = (
+        f"🗂 APPROVAL QUEUE ({tx_type or 'all'})\n"
+        f"📥 {counts['deposit']} deposits | 📤 {counts['withdraw']} withdrawals pending\n"
+        f"━━━━━━━━━━━━━━\n"
+    )
+    kb = []
+    for t in rows:
+        icon = "📥" if t['type'] == 'deposit' else "📤"
+        mark = "☑️" if t['tx_id'] in selected else "⬜"
+        details = str(t['details'])
+        if len(details) > PENDING_DETAILS_LEN: details = details[:PENDING_DETAILS_LEN - 1] + "…"
+        msg += f"{icon} {t['tx_id']} | User {t['user_id']} | ₹{t['amount']} | {t['method']}: {details}\n"
+        kb.append([InlineKeyboardButton(f"{mark} {icon} ₹{t['amount']} · {t['user_id']} · {t['tx_id']}", callback_data=f"pq_t_{t['tx_id']}")])
+    if not rows:
+        msg += "Nothing pending. 🎉\n"
+
+    kb.append([InlineKeyboardButton(f"✅ Approve selected ({len(selected)})", callback_data="pq_ok"),
+               InlineKeyboardButton("❌ Reject selected", callback_data="pq_no")])
+    if rows:
+        kb.append([InlineKeyboardButton(f"⏩ Approve all up to {rows[-1]['tx_id']}", callback_data="pq_upto")])
+    nav = [InlineKeyboardButton("🔄 Refresh", callback_data="pq_refresh")]
+    if ud.get('pq_page'): nav.insert(0, InlineKeyboardButton("⏮ First", callback_data="pq_first"))
+    if next_key: nav.append(InlineKeyboardButton("Next ➡️", callback_data="pq_next"))
+    kb.append(nav)
+    return msg, InlineKeyboardMarkup(kb)
+
+async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    arg = context.args[0].lower() if context.args else ""
+    context.user_data['pq_type'] = arg if arg in ("deposit", "withdraw") else None
+    context.user_data['pq_page'] = None
+    context.user_data['pq_selected'] = set()
+    msg, kb = render_pending_queue(context)
+    await update.message.reply_text(msg, reply_markup=kb)
+
+async def pending_queue_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if q.from_user.id != ADMIN_ID: return await q.answer()
+    ud = context.user_data
+    selected = ud.setdefault('pq_selected', set())
+    data = q.data
+
+    if data.startswith("pq_t_"):
+        tx_id = data[5:]
+        selected.symmetric_difference_update({tx_id})
+        await q.answer()
+    elif data == "pq_next":
+        ud['pq_page'] = ud.get('pq_next')
+        await q.answer()
+    elif data == "pq_first":
+        ud['pq_page'] = None
+        await q.answer()
+    elif data in ("pq_ok", "pq_no", "pq_upto"):
+        decision = "no" if data == "pq_no" else "ok"
+        if data == "pq_upto":
+            if not ud.get('pq_last'): return await q.answer("Nothing to approve.")
+            settled = await asyncio.to_thread(settle_transactions, "ok", up_to=ud['pq_last'], tx_type=ud.get('pq_type'))
+        else:
+            if not selected: return await q.answer("Select transactions first.")
+            settled = await asyncio.to_thread(settle_transactions, decision, tx_ids=list(selected))
+        selected.clear()
+        ud['pq_page'] = None
+        if settled:
+            context.application.create_task(notify_users(context.bot, [(t['user_id'], settlement_message(t, decision)) for t in settled]))
+        await q.answer(f"{'Approved' if decision == 'ok' else 'Rejected'} {len(settled)} transaction(s).", show_alert=True)
+    else:
+        await q.answer()
+
+    msg, kb = render_pending_queue(context)
+    try:
+        await q.edit_message_text(msg, reply_markup=kb)
+    except BadRequest as e:
+        # A refresh that finds nothing new is fine, anything else is a real failure
+        if "message is not modified" not in str(e).lower(): raise
+
 async def token_rig_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     try:
@@ -354,6 +481,103 @@ async def token_rig_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"✅ Rigged. Price anchored.")
     except: await update.message.reply_text("❌ Usage: `/token_rig SYM PRICE`")
 
+async def export_transactions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    try:
+        days = float(context.args[0]) if context.args else 30.0
+        if days <= 0: raise ValueError
+    except ValueError:
+        return await update.message.reply_text("❌ Usage: `/export_tx [DAYS]`", parse_mode="Markdown")
+
+    await update.message.reply_text(f"⏳ Exporting last {days:g} days...")
+    since = time.time() - days * 86400
+    # Rows go straight from the cursor to a temp file so memory stays flat regardless of export size
+    with tempfile.TemporaryFile() as raw:
+        fh = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        count = await asyncio.to_thread(write_transactions_csv, fh, since)
+        fh.flush()
+        fh.detach()
+        raw.seek(0)
+        filename = f"transactions_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
+        await context.bot.send_document(ADMIN_ID, document=raw, filename=filename, caption=f"📄 {count} transactions (last {days:g} days)")
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        return await update.message.reply_text("❌ Usage: `/broadcast MESSAGE` or `/broadcast stop`", parse_mode="Markdown")
+
+    running = get_running_broadcasts()
+    if text.lower() == "stop":
+        for b in running: set_broadcast_status(b['broadcast_id'], "cancelled")
+        return await update.message.reply_text(f"🛑 Stopped {len(running)} broadcast(s).")
+    if running:
+        return await update.message.reply_text(f"⏳ Broadcast `{running[0]['broadcast_id']}` is still running.", parse_mode="Markdown")
+
+    bid = create_broadcast(text)
+    if not bid:
+        return await update.message.reply_text("❌ Database error.")
+    context.application.create_task(broadcast_task(context.bot, get_broadcast(bid)))
+    await update.message.reply_text(f"📣 Broadcast `{bid}` started.", parse_mode="Markdown")
+
+def format_reconcile_report(run):
+    if run is None: return "❌ Database error."
+    msg = (
+        f"📒 **LEDGER RECONCILIATION** `{run['run_id']}`\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"👥 Wallets checked: **{run['checked']}**\n"
+        f"⚠️ Mismatches: **{run['mismatch_count']}**\n"
+        f"⏱ Took {run['finished_at'] - run['started_at']:.1f}s\n"
+    )
+    for m in run['mismatches'][:20]:
+        msg += f"🔸 `{m['user_id']}`: balance ₹{m['balance']:.2f} vs ledger ₹{m['ledger']:.2f} ({m['diff']:+.2f})\n"
+    return msg
+
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    await update.message.reply_text("⏳ Reconciling wallets against the ledger...")
+    run = await asyncio.to_thread(reconcile_ledger)
+    await update.message.reply_text(format_reconcile_report(run), parse_mode="Markdown")
+
+async def send_profile(bot):
+    folded, samples, seconds = await asyncio.to_thread(profiler.stop)
+    if not samples:
+        return await bot.send_message(ADMIN_ID, "⚠️ Profiler collected no samples.")
+    filename = f"profile_{datetime.now().strftime('%Y%m%d_%H%M')}.folded"
+    await bot.send_document(
+        ADMIN_ID, document=io.BytesIO(folded.encode("utf-8")), filename=filename,
+        caption=f"🔥 {samples} samples over {seconds:.0f}s\nCollapsed stacks, open in speedscope.app or flamegraph.pl"
+    )
+
+async def profile_deadline_job(context: ContextTypes.DEFAULT_TYPE):
+    await send_profile(context.bot)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    action = context.args[0].lower() if context.args else ""
+
+    if action == "start":
+        try:
+            seconds = int(context.args[1]) if len(context.args) > 1 else DEFAULT_PROFILE_SECONDS
+        except ValueError:
+            return await update.message.reply_text("❌ Usage: `/profile start [SECONDS]` or `/profile stop`", parse_mode="Markdown")
+        seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+        if not profiler.start(seconds):
+            return await update.message.reply_text("⏳ Profiler is already running.")
+        context.job_queue.run_once(profile_deadline_job, seconds, name="profile_deadline")
+        await update.message.reply_text(f"🔥 Profiling for up to {seconds}s. Send `/profile stop` to finish early.", parse_mode="Markdown")
+
+    elif action == "stop":
+        if not profiler.running:
+            return await update.message.reply_text("❌ Profiler is not running.")
+        for job in context.job_queue.get_jobs_by_name("profile_deadline"):
+            job.schedule_removal()
+        await send_profile(context.bot)
+
+    else:
+        await update.message.reply_text("❌ Usage: `/profile start [SECONDS]` or `/profile stop`", parse_mode="Markdown")
+
 async def token_roi_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     roi_data = get_token_roi_list()
     if not roi_data:
@@ -375,7 +599,7 @@ async def token_roi_list_command(update: Update, context: ContextTypes.DEFAULT_T
 # --- NEW: CURRENT VALUE LOCKED COMMAND ---
 async def token_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    stats = get_current_token_stats()
+    stats = get_current_token_stats(get_price_map())
     
     if not stats:
         return await update.message.reply_text("📊 No tokens are currently held by users.")
@@ -389,7 +613,7 @@ async def token_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 # --- NEW: CURRENT PROFIT RANKING COMMAND ---
 async def token_profits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    stats = get_platform_profit_by_token()
+    stats = get_platform_profit_by_token(get_price_map())
     
     if not stats:
         return await update.message.reply_text("📊 No profit data available yet.")
@@ -404,23 +628,97 @@ async def token_profits_command(update: Update, context: ContextTypes.DEFAULT_TY
 
 # --- USER COMMANDS (REFERRAL, STATS, GIFTS) ---
 
+# user_id -> (timestamp of the newest point, PNG bytes). A chart is only re-rendered once a new point exists
+_performance_charts = {}
+
+def performance_chart(uid, points):
+    cached = _performance_charts.get(uid)
+    if cached and cached[0] == points[-1][0]: return io.BytesIO(cached[1])
+    buf = generate_chart_image("P&L", [p[2] for p in points], title=f"P&L - last {PERFORMANCE_DAYS} days", ylabel="P&L (INR)")
+    if buf is None: return None
+    if len(_performance_charts) >= CHART_CACHE_SIZE: _performance_charts.clear()
+    _performance_charts[uid] = (points[-1][0], buf.getvalue())
+    return buf
+
+async def performance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    points = await asyncio.to_thread(get_portfolio_history, uid, PERFORMANCE_DAYS)
+    if not points:
+        await update.message.reply_text("📉 No portfolio history yet. Snapshots are recorded while you hold tokens.")
+        return
+    
+    first, last = points[0], points[-1]
+    change = last[1] - first[1]
+    sign = "+" if change >= 0 else ""
+    caption = (
+        f"📈 **YOUR PERFORMANCE ({PERFORMANCE_DAYS}D)**\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"📊 **Net Worth:** ₹{last[1]:.2f} ({sign}₹{change:.2f})\n"
+        f"💹 **Trading P&L:** ₹{last[2]:.2f}\n"
+        f"📉 **Low:** ₹{min(p[1] for p in points):.2f}\n"
+        f"📈 **High:** ₹{max(p[1] for p in points):.2f}\n"
+        f"🕒 Since {datetime.fromtimestamp(first[0]).strftime('%d %b %H:%M')}"
+    )
+    chart_buf = await asyncio.to_thread(performance_chart, uid, points) if len(points) > 1 else None
+    if chart_buf:
+        await update.message.reply_photo(photo=chart_buf, caption=caption, parse_mode="Markdown")
+    else:
+        await update.message.reply_text(caption, parse_mode="Markdown")
+
 async def referral_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    user_data = get_user_data(uid)
     bot_username = context.bot.username
     
     ref_link = f"https://t.me/{bot_username}?start=ref_{uid}"
-    ref_count = user_data.get("referral_count", 0)
+    # One indexed read; level-1 signups are exactly the referrals that earned a bonus
+    stats = get_referral_stats(uid)
+    signups, depositors = stats.get("signups", {}), stats.get("depositors", {})
+    ref_count = signups.get("l1", 0)
+    
+    levels_txt = ""
+    for level in range(1, REFERRAL_LEVELS + 1):
+        joined = signups.get(f"l{level}", 0)
+        if joined: levels_txt += f"🔸 Level {level}: {joined} joined · {depositors.get(f'l{level}', 0)} deposited\n"
     
     msg = (
         f"🤝 **INVITE & EARN**\n"
         f"━━━━━━━━━━━━━━\n"
         f"Share your link to invite friends. You will receive **₹50** instantly for every successful new signup!\n\n"
         f"🔗 **Your Referral Link:**\n`{ref_link}`\n\n"
-        f"👥 **Your Referrals:** {ref_count}"
+        f"👥 **Your Referrals:** {ref_count}\n"
+        f"💰 **Active Depositors:** {depositors.get('l1', 0)}\n"
+        f"🌳 **Network:** {sum(signups.values())} users, {stats.get('depth', 0)} levels deep\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"{levels_txt if levels_txt else 'No referrals yet.'}"
     )
     await update.message.reply_text(msg, parse_mode="Markdown")
 
+def mask_user_id(uid):
+    text = str(uid)
+    return text[:2] + "****" + text[-2:] if len(text) > 4 else text
+
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    meta, rows = get_leaderboard(limit=10)
+    if not meta:
+        return await update.message.reply_text("🏆 Leaderboard is being calculated, check back in a few minutes.")
+
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    msg = "🏆 **NET WORTH LEADERBOARD**\n━━━━━━━━━━━━━━\n"
+    for r in rows:
+        badge = medals.get(r['rank'], f"#{r['rank']}")
+        you = " (you)" if r['user_id'] == uid else ""
+        msg += f"{badge} `{mask_user_id(r['user_id'])}`{you}: ₹{r['net_worth']:.2f}\n"
+
+    mine = get_user_rank(uid)
+    msg += "━━━━━━━━━━━━━━\n"
+    if mine:
+        msg += f"📍 **Your Rank:** #{mine['rank']} of {meta['ranked']} (₹{mine['net_worth']:.2f})\n"
+    else:
+        msg += "📍 **Your Rank:** Unranked, deposit or trade to join!\n"
+    msg += f"🕒 Updated {datetime.fromtimestamp(meta['computed_at']).strftime('%H:%M')}"
+    await update.message.reply_text(msg, parse_mode="Markdown")
+
 async def daily_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats = get_daily_stats()
     msg = (
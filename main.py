@@ -1,10 +1,14 @@
+import asyncio
 import logging
 import traceback
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler, ContextTypes
 
 from config import BOT_TOKEN, ADMIN_ID
-from database import get_user_data, update_market_prices
+from database import get_user_data, get_running_broadcasts, reconcile_ledger, build_leaderboard, record_portfolio_snapshots
+from market import engine, TICK_SECONDS, PERSIST_SECONDS, SNAPSHOT_SECONDS
+from dashboard import TimedApplication, start_dashboard, stop_dashboard
+from notifier import broadcast_task
 
 from handlers_wallet import (
     wallet_command, tokens_command, view_token_chart, ask_trade_amount, execute_trade,
@@ -12,7 +16,10 @@ from handlers_wallet import (
     ask_utr, receive_utr, start_withdraw, select_withdraw_method, ask_withdraw_details, 
     process_withdrawal, DEP_AMOUNT, DEP_METHOD, DEP_UTR, WD_AMOUNT, WD_METHOD, WD_DETAILS, TRADE_AMOUNT,
     token_rig_command, token_roi_list_command, daily_stats_command, gen_gift_command, 
-    redeem_command, token_stats_command, token_profits_command, referral_command
+    redeem_command, token_stats_command, token_profits_command, referral_command,
+    history_command, export_transactions_command, broadcast_command,
+    reconcile_command, format_reconcile_report, profile_command, leaderboard_command,
+    pending_command, pending_queue_handler, performance_command
 )
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -61,18 +68,57 @@ async def back_home_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start_command(update, context)
     return ConversationHandler.END
 
-async def market_update_job(context: ContextTypes.DEFAULT_TYPE):
-    update_market_prices()
-    logger.info("📈 Background Job: Market prices updated using Mean-Reversion system.")
+async def market_tick_job(context: ContextTypes.DEFAULT_TYPE):
+    engine.tick()
+
+async def market_persist_job(context: ContextTypes.DEFAULT_TYPE):
+    engine.persist()
+
+async def leaderboard_job(context: ContextTypes.DEFAULT_TYPE):
+    # The valuation joins against the tokens collection, so flush the live prices first
+    engine.persist()
+    ranked = await asyncio.to_thread(build_leaderboard)
+    logger.info(f"🏆 Background Job: Leaderboard rebuilt with {ranked} ranked wallets.")
+
+async def portfolio_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    # Valued at the live engine prices, most runs only write the portfolios that actually moved
+    written = await asyncio.to_thread(record_portfolio_snapshots, engine.prices())
+    if written: logger.info(f"📈 Background Job: Stored {written} portfolio snapshots.")
+
+async def on_shutdown(app: Application):
+    await stop_dashboard()
+    engine.persist()
+    logger.info("📈 Market snapshot saved on shutdown.")
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE):
+    for b in get_running_broadcasts():
+        logger.info(f"📣 Resuming broadcast {b['broadcast_id']} after user {b.get('last_user_id')}")
+        context.application.create_task(broadcast_task(context.bot, b))
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    run = await asyncio.to_thread(reconcile_ledger)
+    logger.info(f"📒 Background Job: Reconciled {run['checked'] if run else 0} wallets.")
+    if run and run['mismatch_count']:
+        await context.bot.send_message(ADMIN_ID, format_reconcile_report(run), parse_mode="Markdown")
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    engine.load()
+    app = (
+        Application.builder().token(BOT_TOKEN).application_class(TimedApplication)
+        .post_init(start_dashboard).post_shutdown(on_shutdown).build()
+    )
     
-    app.job_queue.run_repeating(market_update_job, interval=300, first=10)
+    app.job_queue.run_repeating(market_tick_job, interval=TICK_SECONDS, first=TICK_SECONDS)
+    app.job_queue.run_repeating(market_persist_job, interval=PERSIST_SECONDS, first=PERSIST_SECONDS)
+    app.job_queue.run_once(resume_broadcasts_job, when=5)
+    app.job_queue.run_repeating(reconcile_job, interval=86400, first=600)
+    app.job_queue.run_repeating(leaderboard_job, interval=600, first=60)
+    app.job_queue.run_repeating(portfolio_snapshot_job, interval=SNAPSHOT_SECONDS, first=SNAPSHOT_SECONDS)
     
     # Base Commands
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("wallet", wallet_command))
+    app.add_handler(CommandHandler("history", history_command))
     
     # User Feature Commands
     app.add_handler(CommandHandler("redeem", redeem_command))
@@ -80,15 +126,23 @@ def main():
     app.add_handler(CommandHandler("referral", referral_command))
     app.add_handler(CommandHandler("daily_stats", daily_stats_command))
     app.add_handler(CommandHandler("token_roi_list", token_roi_list_command))
+    app.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    app.add_handler(CommandHandler("performance", performance_command))
     
     # Admin Commands
     app.add_handler(CommandHandler("token_rig", token_rig_command))
     app.add_handler(CommandHandler("gen_gift", gen_gift_command))
     app.add_handler(CommandHandler("token_stats", token_stats_command))
     app.add_handler(CommandHandler("token_profits", token_profits_command)) # NEW PROFIT TRACKER!
+    app.add_handler(CommandHandler("export_tx", export_transactions_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("reconcile", reconcile_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("pending", pending_command))
     
     app.add_handler(CallbackQueryHandler(back_home_handler, pattern="^back_home$"))
     app.add_handler(CallbackQueryHandler(admin_payment_handler, pattern="^adm_(dep|wd)_"))
+    app.add_handler(CallbackQueryHandler(pending_queue_handler, pattern="^pq_"))
 
     # TRADING CONVERSATION (Buy/Sell Amount)
     app.add_handler(ConversationHandler(
@@ -126,6 +180,7 @@ def main():
     app.add_handler(CallbackQueryHandler(wallet_command, pattern="^wallet_main$"))
     app.add_handler(CallbackQueryHandler(tokens_command, pattern="^wallet_tokens$"))
     app.add_handler(CallbackQueryHandler(view_token_chart, pattern="^view_chart_"))
+    app.add_handler(CallbackQueryHandler(history_command, pattern="^hist_"))
     
     print("✅ PURE WALLET BOT ONLINE (Isolated from Wingo)")
     app.run_polling()
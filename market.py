@@ -0,0 +1,108 @@
+import copy
+import time
+import logging
+import threading
+import database
+from database import next_price, save_token_snapshot, MARKET_INTERVAL, HISTORY_LENGTH
+
+logger = logging.getLogger(__name__)
+
+TICK_SECONDS = 3        # how often prices move in memory
+PERSIST_SECONDS = 30    # how often the latest prices are written behind to the tokens collection
+HISTORY_SECONDS = 300   # how often a chart point is appended, keeps 30 points ≈ 2.5 h like before
+SNAPSHOT_SECONDS = 60   # how often portfolios are revalued at live prices for /performance
+
+class MarketEngine:
+    """
+    Authoritative token prices held in process. Reads never touch the database; the
+    tokens collection is only a write-behind snapshot used to recover after a restart.
+    """
+    def __init__(self):
+        self._tokens = {}
+        self._raw = {}      # unrounded prices, so small ticks on cheap tokens don't round away
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_history = 0.0
+        self.loaded = False
+
+    def load(self):
+        """ Recovers from the last persisted snapshot """
+        tokens = database.get_all_tokens()
+        with self._lock:
+            self._tokens = {}
+            self._raw = {}
+            for t in tokens:
+                t.setdefault('base_price', t['price'])
+                t.setdefault('history', [t['price']])
+                self._tokens[t['symbol']] = t
+                self._raw[t['symbol']] = float(t['price'])
+            self._last_history = time.time()
+            self.loaded = bool(self._tokens)
+        logger.info(f"📈 Market engine loaded {len(tokens)} tokens from snapshot.")
+
+    def tick(self, seconds=TICK_SECONDS):
+        step = seconds / MARKET_INTERVAL
+        with self._lock:
+            for sym, t in self._tokens.items():
+                raw = next_price(self._raw[sym], t['base_price'], step)
+                self._raw[sym] = raw
+                t['price'] = max(round(raw, 2), 0.01)
+            self._dirty = True
+
+    def rig(self, symbol, price):
+        """ Admin override: anchors the token at `price` and persists straight away """
+        with self._lock:
+            t = self._tokens.get(symbol)
+            if not t: return False
+            t['price'] = t['base_price'] = float(price)
+            self._raw[symbol] = float(price)
+            t['history'] = (t['history'] + [float(price)])[-HISTORY_LENGTH:]
+            self._dirty = True
+        database.update_token_price(symbol, price)
+        return True
+
+    def persist(self, force_history=False):
+        """ Writes the current snapshot, appending a chart point every HISTORY_SECONDS """
+        now = time.time()
+        with self._lock:
+            push_history = force_history or now - self._last_history >= HISTORY_SECONDS
+            if not self._dirty and not push_history: return
+            if push_history:
+                self._last_history = now
+                for t in self._tokens.values():
+                    t['history'] = (t['history'] + [t['price']])[-HISTORY_LENGTH:]
+            snapshot = [{"symbol": t['symbol'], "price": t['price'], "base_price": t['base_price']} for t in self._tokens.values()]
+            self._dirty = False
+        save_token_snapshot(snapshot, push_history=push_history)
+
+    def all_tokens(self):
+        with self._lock:
+            return copy.deepcopy(list(self._tokens.values()))
+
+    def token(self, symbol):
+        with self._lock:
+            t = self._tokens.get(symbol)
+            return copy.deepcopy(t) if t else None
+
+    def prices(self):
+        with self._lock:
+            return {sym: t['price'] for sym, t in self._tokens.items()}
+
+engine = MarketEngine()
+
+# Same names as the database.py readers, served from memory once the engine is loaded
+def get_all_tokens():
+    return engine.all_tokens() if engine.loaded else database.get_all_tokens()
+
+def get_token_details(symbol):
+    return engine.token(symbol) if engine.loaded else database.get_token_details(symbol)
+
+def get_price_map():
+    return engine.prices() if engine.loaded else None
+
+def get_token_roi_list():
+    return database.get_token_roi_list(engine.all_tokens() if engine.loaded else None)
+
+def update_token_price(symbol, new_price):
+    if engine.loaded: engine.rig(symbol, new_price)
+    else: database.update_token_price(symbol, new_price)
@@ -0,0 +1,111 @@
+import time
+import asyncio
+import logging
+from itertools import islice
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from config import ADMIN_ID
+from database import (
+    iter_broadcast_targets, checkpoint_broadcast, mark_users_blocked,
+    get_broadcast, set_broadcast_status
+)
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows ~30 messages/second to different chats, keep some headroom
+MESSAGES_PER_SECOND = 25
+MAX_CONCURRENCY = 10
+BROADCAST_BATCH_SIZE = 100
+
+class RateLimiter:
+    """ Spaces out sends so the whole process stays under a messages-per-second budget """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+# Shared by every bulk sender so broadcasts and notifications draw from one budget
+limiter = RateLimiter(MESSAGES_PER_SECOND)
+
+async def _send_one(bot, chat_id, text, sem, **kwargs):
+    async with sem:
+        for _ in range(3):
+            await limiter.wait()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return "sent"
+            except RetryAfter as e:
+                delay = e.retry_after
+                await asyncio.sleep(delay.total_seconds() if hasattr(delay, "total_seconds") else delay)
+            except Forbidden:
+                return "blocked"
+            except TelegramError as e:
+                logger.warning(f"Send to {chat_id} failed: {e}")
+                return "failed"
+        return "failed"
+
+async def send_many(bot, messages, **kwargs):
+    """ Sends (chat_id, text) pairs with bounded concurrency. Returns (sent, failed, blocked_ids) """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    messages = list(messages)
+    results = await asyncio.gather(*(_send_one(bot, cid, text, sem, **kwargs) for cid, text in messages))
+
+    sent = results.count("sent")
+    failed = results.count("failed")
+    blocked = [cid for (cid, _), r in zip(messages, results) if r == "blocked"]
+    return sent, failed, blocked
+
+async def notify_users(bot, messages):
+    """ Delivers per-user (chat_id, text) notifications in rate-limited batches """
+    messages = list(messages)
+    for i in range(0, len(messages), BROADCAST_BATCH_SIZE):
+        _, _, blocked = await send_many(bot, messages[i:i + BROADCAST_BATCH_SIZE])
+        mark_users_blocked(blocked)
+
+async def run_broadcast(bot, broadcast):
+    """ Sends a broadcast batch by batch, checkpointing after each so a crash resumes where it stopped """
+    bid, text = broadcast["broadcast_id"], broadcast["text"]
+    targets = iter_broadcast_targets(broadcast.get("last_user_id"))
+    totals = {"sent": broadcast.get("sent", 0), "failed": broadcast.get("failed", 0), "blocked": broadcast.get("blocked", 0)}
+
+    while True:
+        current = get_broadcast(bid)
+        if not current or current["status"] != "running":
+            return current["status"] if current else "missing", totals
+
+        # Cursor batches are fetched off the event loop so polling keeps responding
+        chunk = await asyncio.to_thread(lambda: list(islice(targets, BROADCAST_BATCH_SIZE)))
+        if not chunk: break
+
+        sent, failed, blocked = await send_many(bot, [(uid, text) for uid in chunk])
+        mark_users_blocked(blocked)
+        checkpoint_broadcast(bid, chunk[-1], sent, failed, len(blocked))
+        totals["sent"] += sent
+        totals["failed"] += failed
+        totals["blocked"] += len(blocked)
+
+    set_broadcast_status(bid, "done")
+    return "done", totals
+
+async def broadcast_task(bot, broadcast):
+    try:
+        status, totals = await run_broadcast(bot, broadcast)
+    except Exception as e:
+        # Left as "running" on purpose, the next startup resumes from the checkpoint
+        logger.error(f"❌ Broadcast {broadcast['broadcast_id']} crashed: {e}")
+        return
+
+    await bot.send_message(
+        ADMIN_ID,
+        f"📣 Broadcast `{broadcast['broadcast_id']}` {status}\n"
+        f"✅ Sent: {totals['sent']}\n🚫 Blocked: {totals['blocked']}\n⚠️ Failed: {totals['failed']}",
+        parse_mode="Markdown"
+    )
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.01      # 100 Hz
+DEFAULT_PROFILE_SECONDS = 60
+MAX_PROFILE_SECONDS = 300   # hard cap, the sampler stops itself even if nobody sends /profile stop
+
+class SamplingProfiler:
+    """
+    Samples every thread's Python stack from a background thread and counts identical
+    stacks. Handler coroutines show up under the event-loop thread while they run,
+    sync database.py calls and chart rendering under whichever thread executes them.
+    Output is the collapsed-stack format read by flamegraph.pl, speedscope, etc.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._stacks = Counter()
+        self._samples = 0
+        self._started = 0.0
+        self._finished = 0.0
+        self._deadline = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=DEFAULT_PROFILE_SECONDS):
+        with self._lock:
+            if self.running: return False
+            seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+            self._stacks = Counter()
+            self._samples = 0
+            self._finished = 0.0
+            self._stop.clear()
+            self._started = time.monotonic()
+            self._deadline = self._started + seconds
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """ Stops sampling (if still running) and returns (collapsed_text, samples, seconds) """
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            self._thread = None
+            lines = [f"{stack} {count}" for stack, count in self._stacks.most_common()]
+            return "\n".join(lines) + "\n", self._samples, (self._finished or time.monotonic()) - self._started
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if time.monotonic() >= self._deadline: break
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                self._stacks[";".join(reversed(stack))] += 1
+            self._samples += 1
+        self._finished = time.monotonic()
+
+profiler = SamplingProfiler()
@@ -0,0 +1,1055 @@
+"""
+Storage backends for database.py.
+
+database.py talks to module-level collections through the pymongo Collection API.
+open_database() hands it either a real Mongo database or a stand-in whose collections
+implement the subset of that API the bot uses, so every database.py function runs
+unchanged against:
+
+    mongo   - MongoDB through pymongo (production)
+    sqlite  - one local file, WAL journal, JSON documents with expression indexes
+    memory  - plain dicts in this process, for tests and offline benchmarks
+
+The stand-ins evaluate filters, updates, projections and aggregation pipelines in
+Python. They are meant for a single bot process; they are not a general Mongo clone.
+"""
+import re
+import copy
+import json
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+    from pymongo.errors import DuplicateKeyError, BulkWriteError
+except ImportError:
+    # Same attribute layout as pymongo's request classes, so bulk_write reads both
+    class InsertOne:
+        def __init__(self, document):
+            self._doc = document
+
+    class UpdateOne:
+        def __init__(self, filter, update, upsert=False):
+            self._filter, self._doc, self._upsert = filter, update, upsert
+
+    class UpdateMany(UpdateOne):
+        pass
+
+    class DeleteOne:
+        def __init__(self, filter):
+            self._filter = filter
+
+    class DeleteMany(DeleteOne):
+        pass
+
+    class DuplicateKeyError(Exception):
+        pass
+
+    class BulkWriteError(Exception):
+        def __init__(self, results):
+            super().__init__("batch op errors occurred")
+            self.details = results
+
+BACKENDS = ("mongo", "sqlite", "memory")
+
+def open_database(backend, mongo_uri=None, sqlite_path=None):
+    if backend == "mongo":
+        import certifi
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri, tlsCAFile=certifi.where())
+        return client.crypto_wallet_bot_db
+    if backend == "sqlite":
+        return SQLiteDatabase(sqlite_path)
+    if backend == "memory":
+        return MemoryDatabase()
+    raise ValueError(f"Unknown storage backend '{backend}', expected one of {BACKENDS}")
+
+def run_atomic(database, callback):
+    """
+    Runs callback(session) as one transaction and returns its result. On Mongo that is a
+    session transaction (needs a replica set, which Atlas always is), retried by pymongo on
+    transient errors, so the callback must only touch the database. The stand-ins run it
+    inside their database-wide transaction and pass session=None.
+    """
+    if isinstance(database, (MemoryDatabase, SQLiteDatabase)):
+        with database.transaction():
+            return callback(None)
+    with database.client.start_session() as session:
+        return session.with_transaction(callback)
+
+# ==========================================
+# 1. RESULT OBJECTS
+# ==========================================
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+class InsertManyResult:
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+class BulkWriteResult:
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_count = 0
+
+# ==========================================
+# 2. QUERY / UPDATE / PROJECTION ENGINE
+# ==========================================
+_MISSING = object()
+
+def _get_path(doc, path):
+    cur = doc
+    parts = path.split(".")
+    for i, part in enumerate(parts):
+        if isinstance(cur, dict):
+            cur = cur.get(part, _MISSING)
+        elif isinstance(cur, list) and part.isdigit():
+            cur = cur[int(part)] if int(part) < len(cur) else _MISSING
+        elif isinstance(cur, list):
+            # Like Mongo, a field path through an array of documents yields the array of values
+            rest = ".".join(parts[i:])
+            values = [_get_path(item, rest) for item in cur if isinstance(item, dict)]
+            return [v for v in values if v is not _MISSING]
+        else:
+            return _MISSING
+        if cur is _MISSING:
+            return _MISSING
+    return cur
+
+def _set_path(doc, path, value):
+    parts = path.split(".")
+    cur = doc
+    for part in parts[:-1]:
+        nxt = cur.get(part)
+        if not isinstance(nxt, dict):
+            nxt = {}
+            cur[part] = nxt
+        cur = nxt
+    cur[parts[-1]] = value
+
+def _unset_path(doc, path):
+    parts = path.split(".")
+    cur = doc
+    for part in parts[:-1]:
+        cur = cur.get(part)
+        if not isinstance(cur, dict):
+            return
+    cur.pop(parts[-1], None)
+
+def _type_rank(v):
+    if v is None or v is _MISSING: return 0
+    if isinstance(v, bool): return 5
+    if isinstance(v, (int, float)): return 1
+    if isinstance(v, str): return 2
+    if isinstance(v, dict): return 3
+    if isinstance(v, list): return 4
+    return 6
+
+def _sort_key(v):
+    rank = _type_rank(v)
+    if rank in (1, 2, 5): return (rank, v)
+    if rank == 0: return (0, 0)
+    return (rank, json.dumps(v, sort_keys=True, default=str))
+
+def _compare(a, b):
+    ka, kb = _sort_key(a), _sort_key(b)
+    return (ka > kb) - (ka < kb)
+
+def _values_equal(value, target):
+    if value is _MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    return value == target
+
+def _match_ops(value, ops):
+    for op, arg in ops.items():
+        if op == "$eq":
+            ok = _values_equal(value, arg)
+        elif op == "$ne":
+            ok = not _values_equal(value, arg)
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            # Like Mongo, range operators only compare values of the same type class
+            if value is _MISSING or _type_rank(value) != _type_rank(arg):
+                return False
+            c = _compare(value, arg)
+            ok = {"$gt": c > 0, "$gte": c >= 0, "$lt": c < 0, "$lte": c <= 0}[op]
+        elif op == "$in":
+            ok = any(_values_equal(value, a) for a in arg)
+        elif op == "$nin":
+            ok = not any(_values_equal(value, a) for a in arg)
+        elif op == "$exists":
+            ok = (value is not _MISSING) == bool(arg)
+        elif op == "$size":
+            ok = isinstance(value, list) and len(value) == arg
+        else:
+            raise ValueError(f"Unsupported query operator {op}")
+        if not ok:
+            return False
+    return True
+
+def _is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond)
+
+def match(doc, flt):
+    for key, cond in (flt or {}).items():
+        if key == "$or":
+            if not any(match(doc, f) for f in cond): return False
+        elif key == "$and":
+            if not all(match(doc, f) for f in cond): return False
+        elif key == "$nor":
+            if any(match(doc, f) for f in cond): return False
+        else:
+            value = _get_path(doc, key)
+            if _is_operator_dict(cond):
+                if not _match_ops(value, cond): return False
+            elif not _values_equal(value, cond):
+                return False
+    return True
+
+def _upsert_seed(flt):
+    """ Equality fields of a filter become the base of an upserted document """
+    doc = {}
+    for key, cond in (flt or {}).items():
+        if key.startswith("$"):
+            continue
+        if _is_operator_dict(cond):
+            if "$eq" in cond: _set_path(doc, key, copy.deepcopy(cond["$eq"]))
+        else:
+            _set_path(doc, key, copy.deepcopy(cond))
+    return doc
+
+def apply_update(doc, update, inserting=False):
+    """ Applies a Mongo update document in place """
+    if not any(k.startswith("$") for k in update):
+        keep_id = doc.get("_id")
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if keep_id is not None: doc["_id"] = keep_id
+        return
+
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            if op == "$set":
+                _set_path(doc, path, copy.deepcopy(arg))
+            elif op == "$setOnInsert":
+                if inserting: _set_path(doc, path, copy.deepcopy(arg))
+            elif op == "$unset":
+                _unset_path(doc, path)
+            elif op == "$inc":
+                cur = _get_path(doc, path)
+                _set_path(doc, path, (0 if cur is _MISSING or cur is None else cur) + arg)
+            elif op in ("$min", "$max"):
+                cur = _get_path(doc, path)
+                if cur is _MISSING or (_compare(arg, cur) < 0 if op == "$min" else _compare(arg, cur) > 0):
+                    _set_path(doc, path, copy.deepcopy(arg))
+            elif op == "$push":
+                cur = _get_path(doc, path)
+                arr = list(cur) if isinstance(cur, list) else []
+                if isinstance(arg, dict) and "$each" in arg:
+                    arr.extend(copy.deepcopy(arg["$each"]))
+                    if "$slice" in arg:
+                        n = arg["$slice"]
+                        arr = arr[n:] if n < 0 else arr[:n]
+                else:
+                    arr.append(copy.deepcopy(arg))
+                _set_path(doc, path, arr)
+            elif op == "$pull":
+                cur = _get_path(doc, path)
+                if isinstance(cur, list):
+                    _set_path(doc, path, [v for v in cur if not (match(v, arg) if isinstance(arg, dict) else v == arg)])
+            else:
+                raise ValueError(f"Unsupported update operator {op}")
+
+def project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {k: v for k, v in projection.items() if k != "_id" and v}
+    if include:
+        out = {}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = copy.deepcopy(doc["_id"])
+        for path in include:
+            value = _get_path(doc, path)
+            if value is not _MISSING:
+                _set_path(out, path, copy.deepcopy(value))
+        return out
+    out = copy.deepcopy(doc)
+    for path, v in projection.items():
+        if not v: _unset_path(out, path)
+    return out
+
+def _normalize_sort(key, direction=None):
+    if isinstance(key, str):
+        return [(key, direction if direction is not None else 1)]
+    return [(k, d) for k, d in key]
+
+def sort_docs(docs, spec):
+    # Stable multi-pass sort, least significant key first
+    for field, direction in reversed(spec):
+        docs.sort(key=lambda d: _sort_key(_get_path(d, field)), reverse=direction < 0)
+    return docs
+
+# ==========================================
+# 3. AGGREGATION PIPELINE
+# ==========================================
+def evaluate(expr, doc):
+    if isinstance(expr, str):
+        if expr.startswith("$$ROOT"):
+            return doc if expr == "$$ROOT" else _none(_get_path(doc, expr[7:]))
+        if expr.startswith("$"):
+            return _none(_get_path(doc, expr[1:]))
+        return expr
+    if isinstance(expr, list):
+        return [evaluate(e, doc) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1:
+        op, arg = next(iter(expr.items()))
+        if op.startswith("$"):
+            return _evaluate_operator(op, arg, doc)
+    return {k: evaluate(v, doc) for k, v in expr.items()}
+
+def _none(v):
+    return None if v is _MISSING else v
+
+def _num(v):
+    return v if isinstance(v, (int, float)) and not isinstance(v, bool) else 0
+
+def _evaluate_operator(op, arg, doc):
+    if op == "$literal":
+        return arg
+    args = [evaluate(a, doc) for a in arg] if isinstance(arg, list) else None
+    if op == "$ifNull":
+        for v in args:
+            if v is not None: return v
+        return None
+    if op == "$objectToArray":
+        v = evaluate(arg, doc)
+        return [{"k": k, "v": val} for k, val in v.items()] if isinstance(v, dict) else None
+    if op == "$arrayToObject":
+        v = evaluate(arg, doc) or []
+        return {item["k"]: item["v"] for item in v}
+    if op == "$size":
+        v = evaluate(arg, doc)
+        return len(v) if isinstance(v, list) else 0
+    if op == "$sum":
+        if args is None:
+            v = evaluate(arg, doc)
+            return sum(_num(x) for x in v) if isinstance(v, list) else _num(v)
+        return sum(_num(x) for x in args)
+    if op == "$add":
+        return sum(_num(x) for x in args)
+    if op == "$subtract":
+        return _num(args[0]) - _num(args[1])
+    if op == "$multiply":
+        out = 1
+        for x in args: out *= _num(x)
+        return out
+    if op == "$divide":
+        return _num(args[0]) / args[1] if args[1] else None
+    if op == "$round":
+        return round(_num(args[0]), args[1] if len(args) > 1 else 0)
+    if op == "$abs":
+        return abs(_num(evaluate(arg, doc)))
+    if op in ("$gt", "$gte", "$lt", "$lte", "$eq", "$ne"):
+        c = _compare(args[0], args[1])
+        return {"$gt": c > 0, "$gte": c >= 0, "$lt": c < 0, "$lte": c <= 0, "$eq": c == 0, "$ne": c != 0}[op]
+    if op == "$and":
+        return all(args)
+    if op == "$or":
+        return any(args)
+    if op == "$not":
+        return not (args[0] if args is not None else evaluate(arg, doc))
+    if op == "$cond":
+        if isinstance(arg, dict):
+            arg = [arg["if"], arg["then"], arg["else"]]
+        return evaluate(arg[1], doc) if evaluate(arg[0], doc) else evaluate(arg[2], doc)
+    if op == "$max":
+        vals = [v for v in (args if args is not None else evaluate(arg, doc) or []) if v is not None]
+        return max(vals, key=_sort_key) if vals else None
+    if op == "$min":
+        vals = [v for v in (args if args is not None else evaluate(arg, doc) or []) if v is not None]
+        return min(vals, key=_sort_key) if vals else None
+    if op == "$arrayElemAt":
+        arr, idx = args
+        return arr[idx] if isinstance(arr, list) and -len(arr) <= idx < len(arr) else None
+    if op == "$getField":
+        field = arg["field"] if isinstance(arg, dict) else arg
+        source = evaluate(arg.get("input", "$$ROOT"), doc) if isinstance(arg, dict) else doc
+        return _none(source.get(field, _MISSING)) if isinstance(source, dict) else None
+    if op == "$filter":
+        items = evaluate(arg["input"], doc) or []
+        name = arg.get("as", "this")
+        return [i for i in items if evaluate(_bind(arg["cond"], name), {**doc, "__var__": i})]
+    if op == "$map":
+        items = evaluate(arg["input"], doc) or []
+        name = arg.get("as", "this")
+        return [evaluate(_bind(arg["in"], name), {**doc, "__var__": i}) for i in items]
+    raise ValueError(f"Unsupported aggregation operator {op}")
+
+def _bind(expr, name):
+    """ Rewrites $$name references to a reserved field so evaluate() can resolve them """
+    if isinstance(expr, str) and expr.startswith(f"$${name}"):
+        return "$__var__" + expr[len(name) + 2:]
+    if isinstance(expr, list):
+        return [_bind(e, name) for e in expr]
+    if isinstance(expr, dict):
+        return {k: _bind(v, name) for k, v in expr.items()}
+    return expr
+
+_ACCUMULATORS = ("$sum", "$avg", "$min", "$max", "$first", "$last", "$push", "$addToSet", "$count")
+
+def _stage_group(docs, spec):
+    groups = {}
+    order = []
+    for doc in docs:
+        key = evaluate(spec["_id"], doc)
+        hkey = json.dumps(key, sort_keys=True, default=str)
+        if hkey not in groups:
+            groups[hkey] = {"_id": key}
+            order.append(hkey)
+        g = groups[hkey]
+        for field, acc in spec.items():
+            if field == "_id": continue
+            op, arg = next(iter(acc.items()))
+            value = None if op == "$count" else evaluate(arg, doc)
+            if op in ("$sum", "$count"):
+                g[field] = g.get(field, 0) + (1 if op == "$count" else _num(value))
+            elif op == "$avg":
+                s, n = g.get(field, (0, 0))
+                g[field] = (s + _num(value), n + (1 if isinstance(value, (int, float)) else 0))
+            elif op == "$min":
+                if value is not None and (field not in g or _compare(value, g[field]) < 0): g[field] = value
+            elif op == "$max":
+                if value is not None and (field not in g or _compare(value, g[field]) > 0): g[field] = value
+            elif op == "$first":
+                g.setdefault(field, value)
+            elif op == "$last":
+                g[field] = value
+            elif op == "$push":
+                g.setdefault(field, []).append(value)
+            elif op == "$addToSet":
+                bucket = g.setdefault(field, [])
+                if value not in bucket: bucket.append(value)
+            else:
+                raise ValueError(f"Unsupported accumulator {op}")
+    for hkey in order:
+        g = groups[hkey]
+        for field, acc in spec.items():
+            if field != "_id" and "$avg" in acc:
+                s, n = g.get(field, (0, 0))
+                g[field] = s / n if n else None
+        yield g
+
+def _stage_project(doc, spec):
+    include_id = spec.get("_id", 1)
+    fields = {k: v for k, v in spec.items() if k != "_id"}
+    if fields and all(v in (0, False) for v in fields.values()):
+        return project(doc, spec)
+    out = {}
+    if include_id and "_id" in doc:
+        out["_id"] = doc["_id"] if include_id in (1, True) else evaluate(include_id, doc)
+    elif include_id not in (0, False, 1, True):
+        out["_id"] = evaluate(include_id, doc)
+    for field, v in fields.items():
+        if v in (1, True):
+            value = _get_path(doc, field)
+            if value is not _MISSING: _set_path(out, field, value)
+        else:
+            _set_path(out, field, evaluate(v, doc))
+    return out
+
+def _stage_unwind(docs, spec):
+    path = spec if isinstance(spec, str) else spec["path"]
+    keep_empty = isinstance(spec, dict) and spec.get("preserveNullAndEmptyArrays", False)
+    field = path[1:]
+    for doc in docs:
+        value = _get_path(doc, field)
+        if isinstance(value, list) and value:
+            for item in value:
+                out = copy.deepcopy(doc) if "." in field else dict(doc)
+                _set_path(out, field, item)
+                yield out
+        elif isinstance(value, list) or value is _MISSING or value is None:
+            if keep_empty: yield doc
+        else:
+            yield doc
+
+def run_pipeline(collection, pipeline):
+    stages = list(pipeline)
+    first_match = stages.pop(0)["$match"] if stages and "$match" in stages[0] else {}
+    docs = iter(collection.find(first_match))
+    for stage in stages:
+        (name, spec), = stage.items()
+        docs = _apply_stage(collection, docs, name, spec)
+    return docs
+
+def _apply_stage(collection, docs, name, spec):
+    if name == "$match":
+        return (d for d in docs if match(d, spec))
+    if name == "$project":
+        return (_stage_project(d, spec) for d in docs)
+    if name in ("$addFields", "$set"):
+        return ({**d, **{k: evaluate(v, d) for k, v in spec.items()}} for d in docs)
+    if name == "$unset":
+        fields = [spec] if isinstance(spec, str) else spec
+        return (project(d, {f: 0 for f in fields}) for d in docs)
+    if name == "$unwind":
+        return _stage_unwind(docs, spec)
+    if name == "$group":
+        return _stage_group(docs, spec)
+    if name == "$sort":
+        return iter(sort_docs(list(docs), list(spec.items())))
+    if name == "$limit":
+        return (d for _, d in zip(range(spec), docs))
+    if name == "$skip":
+        return (d for i, d in enumerate(docs) if i >= spec)
+    if name == "$count":
+        total = sum(1 for _ in docs)
+        return iter([{spec: total}] if total else [])
+    if name == "$replaceRoot":
+        return (evaluate(spec["newRoot"], d) for d in docs)
+    if name == "$lookup":
+        return _stage_lookup(collection.database, docs, spec)
+    raise ValueError(f"Unsupported aggregation stage {name}")
+
+def _stage_lookup(database, docs, spec):
+    foreign = getattr(database, spec["from"])
+    cache = {}
+    for doc in docs:
+        local = _none(_get_path(doc, spec["localField"]))
+        hkey = json.dumps(local, sort_keys=True, default=str)
+        if hkey not in cache:
+            cache[hkey] = list(foreign.find({spec["foreignField"]: local}))
+        out = dict(doc)
+        out[spec["as"]] = copy.deepcopy(cache[hkey])
+        yield out
+
+# ==========================================
+# 4. SHARED COLLECTION BEHAVIOUR
+# ==========================================
+class Cursor:
+    def __init__(self, collection, flt, projection):
+        self._collection = collection
+        self._filter = flt or {}
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+
+    def sort(self, key, direction=None):
+        self._sort = _normalize_sort(key, direction)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        self._batch_size = n
+        return self
+
+    def __iter__(self):
+        produced = 0
+        for i, doc in enumerate(self._collection._scan(self._filter, self._sort, self._batch_size)):
+            if i < self._skip: continue
+            yield project(doc, self._projection)
+            produced += 1
+            if self._limit and produced >= self._limit: break
+
+class DocumentCollection:
+    """ pymongo-compatible collection over a keyed document store supplied by a subclass """
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    # Subclasses implement: _scan, _get, _insert, _replace, _delete, _transaction, _unique_fields.
+    # `session` is accepted for pymongo compatibility; writes already join the open transaction.
+
+    def find(self, filter=None, projection=None, session=None):
+        return Cursor(self, filter, projection)
+
+    def find_one(self, filter=None, projection=None, sort=None, session=None):
+        cursor = self.find(filter, projection).limit(1)
+        if sort: cursor.sort(sort)
+        for doc in cursor:
+            return doc
+        return None
+
+    def count_documents(self, filter, session=None):
+        return sum(1 for _ in self._scan(filter or {}, None, 0))
+
+    def estimated_document_count(self):
+        return self.count_documents({})
+
+    def distinct(self, key, filter=None, session=None):
+        seen = []
+        for doc in self._scan(filter or {}, None, 0):
+            value = _get_path(doc, key)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not _MISSING and v not in seen: seen.append(v)
+        return seen
+
+    def aggregate(self, pipeline, **kwargs):
+        return run_pipeline(self, pipeline)
+
+    def insert_one(self, document, session=None):
+        with self._transaction():
+            document.setdefault("_id", uuid.uuid4().hex[:24])
+            self._check_unique(document)
+            self._insert(copy.deepcopy(document))
+        return InsertOneResult(document["_id"])
+
+    def insert_many(self, documents, ordered=True, session=None):
+        # Mongo semantics: documents written before a duplicate stay written; ordered stops
+        # at the first duplicate, unordered skips it and carries on. Either way it raises after.
+        ids, errors = [], []
+        with self._transaction():
+            for i, d in enumerate(documents):
+                try:
+                    ids.append(self.insert_one(d).inserted_id)
+                except DuplicateKeyError as e:
+                    errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                    if ordered: break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(ids)})
+        return InsertManyResult(ids)
+
+    def _keys_matching(self, flt, sort=None, first_only=False):
+        keys = []
+        for key, _ in self._scan_keyed(flt or {}, sort):
+            keys.append(key)
+            if first_only: break
+        return keys
+
+    def _update(self, flt, update, upsert, many, sort=None):
+        with self._transaction():
+            keys = self._keys_matching(flt, sort, first_only=not many)
+            modified = 0
+            for key in keys:
+                doc = self._get(key)
+                before = json.dumps(doc, sort_keys=True, default=str)
+                apply_update(doc, update)
+                if json.dumps(doc, sort_keys=True, default=str) != before:
+                    self._check_unique(doc, key)
+                    self._replace(key, doc)
+                    modified += 1
+            if keys or not upsert:
+                return UpdateResult(len(keys), modified)
+            doc = _upsert_seed(flt)
+            apply_update(doc, update, inserting=True)
+            doc.setdefault("_id", uuid.uuid4().hex[:24])
+            self._check_unique(doc)
+            self._insert(doc)
+            return UpdateResult(0, 0, doc["_id"])
+
+    def update_one(self, filter, update, upsert=False, sort=None, session=None):
+        return self._update(filter, update, upsert, many=False, sort=_normalize_sort(sort) if sort else None)
+
+    def update_many(self, filter, update, upsert=False, session=None):
+        return self._update(filter, update, upsert, many=True)
+
+    def replace_one(self, filter, replacement, upsert=False, session=None):
+        return self._update(filter, replacement, upsert, many=False)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, return_document=False, session=None):
+        with self._transaction():
+            keys = self._keys_matching(filter, _normalize_sort(sort) if sort else None, first_only=True)
+            if keys:
+                before = self._get(keys[0])
+                self._update({"_id": before["_id"]}, update, False, many=False)
+                doc = self._get(keys[0]) if return_document else before
+                return project(doc, projection)
+            if not upsert:
+                return None
+            result = self._update(filter, update, True, many=False)
+            return project(self.find_one({"_id": result.upserted_id}), projection) if return_document else None
+
+    def delete_one(self, filter, session=None):
+        with self._transaction():
+            keys = self._keys_matching(filter, first_only=True)
+            for key in keys: self._delete(key)
+        return DeleteResult(len(keys))
+
+    def delete_many(self, filter, session=None):
+        with self._transaction():
+            keys = self._keys_matching(filter)
+            for key in keys: self._delete(key)
+        return DeleteResult(len(keys))
+
+    def bulk_write(self, requests, ordered=True, session=None):
+        # Same error semantics as insert_many
+        result, errors = BulkWriteResult(), []
+        with self._transaction():
+            for i, req in enumerate(requests):
+                try:
+                    self._bulk_one(req, result)
+                except DuplicateKeyError as e:
+                    errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                    if ordered: break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": result.inserted_count,
+                                  "nMatched": result.matched_count, "nModified": result.modified_count})
+        return result
+
+    def _bulk_one(self, req, result):
+        if isinstance(req, InsertOne):
+            self.insert_one(req._doc)
+            result.inserted_count += 1
+        elif isinstance(req, (UpdateOne, UpdateMany)):
+            r = self._update(req._filter, req._doc, req._upsert, many=isinstance(req, UpdateMany))
+            result.matched_count += r.matched_count
+            result.modified_count += r.modified_count
+            result.upserted_count += 1 if r.upserted_id is not None else 0
+        elif isinstance(req, (DeleteOne, DeleteMany)):
+            r = (self.delete_many if isinstance(req, DeleteMany) else self.delete_one)(req._filter)
+            result.deleted_count += r.deleted_count
+        else:
+            raise ValueError(f"Unsupported bulk request {type(req).__name__}")
+
+    def _check_unique(self, doc, own_key=None):
+        # Unique indexes are field tuples, so compound keys are only duplicates on the whole tuple
+        for fields in self._unique_fields():
+            values = [_get_path(doc, f) for f in fields]
+            if all(v is _MISSING for v in values): continue
+            flt = {f: (None if v is _MISSING else v) for f, v in zip(fields, values)}
+            for key, _ in self._scan_keyed(flt, None):
+                if key != own_key:
+                    raise DuplicateKeyError(f"E11000 duplicate key on {self.name}.{'+'.join(fields)}: {tuple(flt.values())!r}")
+
+    def _scan(self, flt, sort, batch_size):
+        for _, doc in self._scan_keyed(flt, sort, batch_size):
+            yield doc
+
+def _index_fields(keys):
+    if isinstance(keys, str):
+        return [(keys, 1)]
+    return [(k, d) for k, d in keys]
+
+# ==========================================
+# 5. IN-MEMORY BACKEND
+# ==========================================
+class MemoryCollection(DocumentCollection):
+    def __init__(self, database, name):
+        super().__init__(database, name)
+        self._docs = {}
+        self._seq = 0
+        # field -> {value: set(keys)}, plus the keys whose value cannot be hashed
+        self._indexes = {}
+        self._unindexable = {}
+        self._unique = set()
+        self.create_index("_id", unique=True)
+
+    def _transaction(self):
+        return self.database.transaction()
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        fields = _index_fields(keys)
+        field = fields[0][0]
+        with self.database.lock:
+            if field not in self._indexes:
+                self._indexes[field] = {}
+                self._unindexable[field] = set()
+                for key, doc in self._docs.items():
+                    self._index_add(field, key, doc)
+            if unique:
+                self._unique.add(tuple(f for f, _ in fields))
+        return name or "_".join(f"{f}_{d}" for f, d in fields)
+
+    def _unique_fields(self):
+        return self._unique
+
+    def _index_add(self, field, key, doc):
+        value = _get_path(doc, field)
+        try:
+            if isinstance(value, (list, dict)): raise TypeError
+            self._indexes[field].setdefault(value, set()).add(key)
+        except TypeError:
+            self._unindexable[field].add(key)
+
+    def _index_remove(self, field, key, doc):
+        value = _get_path(doc, field)
+        self._unindexable[field].discard(key)
+        try:
+            bucket = self._indexes[field].get(value)
+        except TypeError:
+            return
+        if bucket:
+            bucket.discard(key)
+            if not bucket: del self._indexes[field][value]
+
+    def _candidates(self, flt):
+        for field, cond in flt.items():
+            if field not in self._indexes: continue
+            if _is_operator_dict(cond):
+                if set(cond) == {"$eq"}: cond = cond["$eq"]
+                elif set(cond) == {"$in"} and all(v is not None and not isinstance(v, (list, dict)) for v in cond["$in"]):
+                    keys = set(self._unindexable[field])
+                    for v in cond["$in"]: keys |= self._indexes[field].get(v, set())
+                    return keys
+                else: continue
+            if cond is None or isinstance(cond, (list, dict)): continue
+            return self._indexes[field].get(cond, set()) | self._unindexable[field]
+        return None
+
+    def _scan_keyed(self, flt, sort, batch_size=0):
+        with self.database.lock:
+            candidates = self._candidates(flt)
+            keys = list(self._docs) if candidates is None else sorted(candidates)
+            hits = [(k, self._docs[k]) for k in keys if k in self._docs and match(self._docs[k], flt)]
+        if sort:
+            order = sort_docs([doc for _, doc in hits], sort)
+            by_id = {id(doc): key for key, doc in hits}
+            hits = [(by_id[id(doc)], doc) for doc in order]
+        for key, doc in hits:
+            yield key, doc
+
+    def _get(self, key):
+        return copy.deepcopy(self._docs[key])
+
+    def _put(self, key, doc):
+        old = self._docs.get(key)
+        for field in self._indexes:
+            if old is not None: self._index_remove(field, key, old)
+            self._index_add(field, key, doc)
+        self._docs[key] = doc
+
+    def _drop(self, key):
+        old = self._docs.pop(key)
+        for field in self._indexes: self._index_remove(field, key, old)
+
+    # Stored documents are never mutated in place, so undo entries can keep references
+    def _insert(self, doc):
+        self._seq += 1
+        key = self._seq
+        self.database.journal(lambda: self._drop(key))
+        self._put(key, doc)
+
+    def _replace(self, key, doc):
+        old = self._docs[key]
+        self.database.journal(lambda: self._put(key, old))
+        self._put(key, doc)
+
+    def _delete(self, key):
+        old = self._docs[key]
+        self.database.journal(lambda: self._put(key, old))
+        self._drop(key)
+
+class MemoryDatabase:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._undo = []
+        self._collections = {}
+
+    @contextmanager
+    def transaction(self):
+        """ Same nesting as SQLiteDatabase.transaction; a failure is rolled back from an undo log """
+        with self.lock:
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    for undo in reversed(self._undo): undo()
+                    self._undo = []
+                raise
+            self._depth -= 1
+            if self._depth == 0: self._undo = []
+
+    def journal(self, undo):
+        if self._depth: self._undo.append(undo)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(self, name)
+        return self._collections[name]
+
+# ==========================================
+# 6. SQLITE BACKEND
+# ==========================================
+_SAFE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_SAFE_PATH = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+def _json_expr(field):
+    # Must be spelled identically in CREATE INDEX and in queries for SQLite to use the index
+    return f"json_extract(doc, '$.{field}')"
+
+def _sql_scalar(v):
+    return isinstance(v, (int, float, str)) and not isinstance(v, bool)
+
+class SQLiteCollection(DocumentCollection):
+    """
+    Documents live as JSON text, one row each. Equality, $in and range conditions on
+    plain fields plus the sort are pushed into SQL (and hit json_extract expression
+    indexes); the full filter is then re-checked in Python on the rows that come back.
+    """
+    def __init__(self, database, name):
+        if not _SAFE_NAME.match(name):
+            raise ValueError(f"Invalid collection name {name!r}")
+        super().__init__(database, name)
+        self._unique = set()
+        with self.database.lock:
+            self.database.conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (id INTEGER PRIMARY KEY, doc TEXT NOT NULL)')
+            self.database.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{name}___id" ON "{name}" ({_json_expr("_id")})')
+            for (sql,) in self.database.conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql LIKE 'CREATE UNIQUE%'", (name,)
+            ):
+                fields = re.findall(r"json_extract\(doc, '\$\.([^']+)'\)", sql)
+                if fields: self._unique.add(tuple(fields))
+
+    def _transaction(self):
+        return self.database.transaction()
+
+    def _unique_fields(self):
+        return self._unique
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        fields = _index_fields(keys)
+        for f, _ in fields:
+            if not _SAFE_PATH.match(f): raise ValueError(f"Invalid index field {f!r}")
+        name = name or "_".join(f"{f.replace('.', '_')}_{d}" for f, d in fields)
+        cols = ", ".join(f"{_json_expr(f)} {'DESC' if d == -1 else 'ASC'}" for f, d in fields)
+        with self.database.lock:
+            self.database.conn.execute(
+                f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{self.name}__{name}" ON "{self.name}" ({cols})'
+            )
+            if unique:
+                self._unique.add(tuple(f for f, _ in fields))
+        return name
+
+    def _pushdown(self, flt):
+        clauses, params = [], []
+        for field, cond in flt.items():
+            if field.startswith("$") or not _SAFE_PATH.match(field): continue
+            expr = _json_expr(field)
+            if _sql_scalar(cond):
+                clauses.append(f"{expr} = ?"); params.append(cond)
+            elif _is_operator_dict(cond):
+                for op, arg in cond.items():
+                    sql_op = {"$eq": "=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}.get(op)
+                    if sql_op and _sql_scalar(arg):
+                        clauses.append(f"{expr} {sql_op} ?"); params.append(arg)
+                    elif op == "$in" and arg and all(_sql_scalar(a) for a in arg):
+                        clauses.append(f"{expr} IN ({', '.join('?' * len(arg))})"); params.extend(arg)
+        return clauses, params
+
+    def _scan_keyed(self, flt, sort, batch_size=0):
+        clauses, params = self._pushdown(flt)
+        sql = f'SELECT id, doc FROM "{self.name}"'
+        if clauses: sql += " WHERE " + " AND ".join(clauses)
+        order = []
+        for field, direction in (sort or []):
+            if not _SAFE_PATH.match(field):
+                order = None
+                break
+            order.append(f"{_json_expr(field)} {'DESC' if direction < 0 else 'ASC'}")
+        if order is not None:
+            sql += " ORDER BY " + ", ".join(order + ["id"])
+
+        with self.database.lock:
+            cur = self.database.conn.execute(sql, params)
+        rows = self._stream(cur, batch_size or 256)
+        hits = ((key, doc) for key, doc in rows if match(doc, flt))
+        if order is None:
+            listed = list(hits)
+            order_docs = sort_docs([d for _, d in listed], sort)
+            by_id = {id(d): k for k, d in listed}
+            hits = ((by_id[id(d)], d) for d in order_docs)
+        for key, doc in hits:
+            yield key, doc
+
+    def _stream(self, cur, batch_size):
+        while True:
+            with self.database.lock:
+                rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            for key, raw in rows:
+                yield key, json.loads(raw)
+
+    def _get(self, key):
+        row = self.database.conn.execute(f'SELECT doc FROM "{self.name}" WHERE id = ?', (key,)).fetchone()
+        return json.loads(row[0])
+
+    def _write(self, sql, params):
+        # _check_unique runs first; a constraint it missed still surfaces the way pymongo reports it
+        try:
+            self.database.conn.execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f"E11000 duplicate key on {self.name}: {e}") from e
+
+    def _insert(self, doc):
+        self._write(f'INSERT INTO "{self.name}" (doc) VALUES (?)', (json.dumps(doc, default=str),))
+
+    def _replace(self, key, doc):
+        self._write(f'UPDATE "{self.name}" SET doc = ? WHERE id = ?', (json.dumps(doc, default=str), key))
+
+    def _delete(self, key):
+        self.database.conn.execute(f'DELETE FROM "{self.name}" WHERE id = ?', (key,))
+
+class SQLiteDatabase:
+    def __init__(self, path):
+        # Autocommit mode; multi-statement writes open their own transaction below.
+        # sqlite3 keeps a per-connection cache of prepared statements keyed by SQL text,
+        # and every statement here is parameterised, so hot queries are compiled once.
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=512)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._collections = {}
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self._depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0: self.conn.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0: self.conn.execute("COMMIT")
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self._collections:
+                self._collections[name] = SQLiteCollection(self, name)
+            return self._collections[name]
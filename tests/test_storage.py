@@ -0,0 +1,188 @@
+import pytest
+
+from storage import open_database, run_atomic, DuplicateKeyError, BulkWriteError, UpdateOne, InsertOne, DeleteOne
+
+@pytest.fixture(params=["memory", "sqlite"])
+def db(request, tmp_path):
+    return open_database(request.param, sqlite_path=str(tmp_path / "test.db"))
+
+@pytest.fixture
+def txs(db):
+    coll = db.transactions
+    coll.create_index([("user_id", 1), ("timestamp", -1), ("tx_id", -1)])
+    coll.create_index("tx_id", unique=True)
+    coll.insert_many([
+        {"tx_id": "a", "user_id": 1, "type": "deposit", "amount": 10.0, "status": "pending", "timestamp": 100.0},
+        {"tx_id": "b", "user_id": 1, "type": "deposit", "amount": 20.0, "status": "pending", "timestamp": 200.0},
+        {"tx_id": "c", "user_id": 1, "type": "withdraw", "amount": 5.0, "status": "completed", "timestamp": 200.0},
+        {"tx_id": "d", "user_id": 2, "type": "deposit", "amount": 7.0, "status": "pending", "timestamp": 300.0},
+    ])
+    return coll
+
+# ==========================================
+# 1. QUERIES & CURSORS
+# ==========================================
+def test_keyset_or_pages_without_gaps(txs):
+    sort = [("timestamp", -1), ("tx_id", -1)]
+    first = list(txs.find({"user_id": 1}, {"_id": 0}).sort(sort).limit(2))
+    assert [t["tx_id"] for t in first] == ["c", "b"]
+
+    ts, tx_id = first[-1]["timestamp"], first[-1]["tx_id"]
+    query = {"user_id": 1, "$or": [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "tx_id": {"$lt": tx_id}}]}
+    assert [t["tx_id"] for t in txs.find(query).sort(sort).limit(2)] == ["a"]
+
+def test_projection_include_exclude_and_dotted(db):
+    db.users.insert_one({"user_id": 1, "wallet": {"balance": 5.0, "holdings": {"TET": 3, "GLL": 1}}})
+    assert db.users.find_one({"user_id": 1}, {"_id": 0, "wallet.balance": 1}) == {"wallet": {"balance": 5.0}}
+    assert db.users.find_one({"user_id": 1}, {"_id": 0, "wallet.holdings.TET": 1}) == {"wallet": {"holdings": {"TET": 3}}}
+    assert "holdings" not in db.users.find_one({"user_id": 1}, {"wallet.holdings": 0})["wallet"]
+
+def test_operators_in_ne_exists(txs):
+    assert txs.count_documents({"status": {"$in": ["pending"]}, "user_id": {"$ne": 2}}) == 2
+    assert txs.count_documents({"note": {"$exists": False}}) == 4
+    assert sorted(txs.distinct("type")) == ["deposit", "withdraw"]
+
+# ==========================================
+# 2. UPDATES
+# ==========================================
+def test_push_each_slice_keeps_tail(db):
+    db.tokens.insert_one({"symbol": "TET", "history": [1, 2, 3]})
+    db.tokens.update_one({"symbol": "TET"}, {"$push": {"history": {"$each": [4, 5], "$slice": -3}}})
+    assert db.tokens.find_one({"symbol": "TET"})["history"] == [3, 4, 5]
+
+def test_upsert_seeds_equality_fields(db):
+    db.daily_stats.update_one({"date": "2024-01-01"}, {"$inc": {"new_users": 1}}, upsert=True)
+    db.daily_stats.update_one({"date": "2024-01-01"}, {"$inc": {"new_users": 1}}, upsert=True)
+    db.stats.update_one({"name": {"$eq": "x"}, "n": {"$gt": 1}}, {"$setOnInsert": {"created": True}}, upsert=True)
+    assert db.daily_stats.find_one({"date": "2024-01-01"}, {"_id": 0}) == {"date": "2024-01-01", "new_users": 2}
+    assert db.stats.find_one({}, {"_id": 0}) == {"name": "x", "created": True}
+
+def test_inc_min_max_unset(db):
+    db.users.insert_one({"user_id": 1, "wallet": {"balance": 10.0}, "note": "x"})
+    db.users.update_one({"user_id": 1}, {"$inc": {"wallet.balance": -2.5, "wallet.holdings.TET": 2}, "$max": {"depth": 3}, "$unset": {"note": ""}})
+    db.users.update_one({"user_id": 1}, {"$max": {"depth": 1}, "$min": {"low": 4}})
+    assert db.users.find_one({"user_id": 1}, {"_id": 0}) == {"user_id": 1, "wallet": {"balance": 7.5, "holdings": {"TET": 2}}, "depth": 3, "low": 4}
+
+def test_find_one_and_update_returns_before_or_after(db):
+    db.gift_codes.insert_many([{"code": "A", "is_used": False}, {"code": "B", "is_used": False}])
+    before = db.gift_codes.find_one_and_update({"code": "A", "is_used": False}, {"$set": {"is_used": True}})
+    assert before["is_used"] is False
+    assert db.gift_codes.find_one_and_update({"code": "A", "is_used": False}, {"$set": {"is_used": True}}) is None
+
+    after = db.gift_codes.find_one_and_update({"code": "B"}, {"$set": {"is_used": True}}, projection={"_id": 0}, return_document=True)
+    assert after == {"code": "B", "is_used": True}
+    assert db.gift_codes.find_one_and_update({"code": "C"}, {"$set": {"n": 1}}, upsert=True) is None
+    assert db.gift_codes.find_one_and_update({"code": "D"}, {"$set": {"n": 1}}, upsert=True, return_document=True)["n"] == 1
+
+# ==========================================
+# 3. BULK WRITES & UNIQUE INDEXES
+# ==========================================
+def test_bulk_write_mixed_requests(txs):
+    result = txs.bulk_write([
+        UpdateOne({"tx_id": "a"}, {"$set": {"status": "completed"}}),
+        UpdateOne({"tx_id": "zz"}, {"$set": {"status": "pending"}}, upsert=True),
+        InsertOne({"tx_id": "e", "user_id": 3}),
+        DeleteOne({"tx_id": "d"}),
+    ], ordered=False)
+    assert (result.modified_count, result.upserted_count, result.inserted_count, result.deleted_count) == (1, 1, 1, 1)
+    assert sorted(txs.distinct("tx_id")) == ["a", "b", "c", "e", "zz"]
+
+def test_unique_index_rejects_duplicates(txs):
+    with pytest.raises(DuplicateKeyError):
+        txs.insert_one({"tx_id": "a"})
+    with pytest.raises(DuplicateKeyError):
+        txs.update_one({"tx_id": "b"}, {"$set": {"tx_id": "a"}})
+
+@pytest.mark.parametrize("ordered, kept", [(True, ["x1"]), (False, ["x1", "x2"])])
+def test_insert_many_duplicate_matches_mongo(txs, ordered, kept):
+    with pytest.raises(BulkWriteError) as err:
+        txs.insert_many([{"tx_id": "x1"}, {"tx_id": "a"}, {"tx_id": "x2"}], ordered=ordered)
+    assert err.value.details["writeErrors"][0]["index"] == 1
+    assert sorted(t for t in txs.distinct("tx_id") if t.startswith("x")) == kept
+
+# ==========================================
+# 4. AGGREGATION
+# ==========================================
+def test_lookup_unwind_group(db):
+    db.tokens.insert_many([{"symbol": "TET", "price": 10.0}, {"symbol": "GLL", "price": 2.0}])
+    db.users.insert_many([
+        {"user_id": 1, "wallet": {"balance": 5.0, "holdings": {"TET": 2, "GLL": 5}}},
+        {"user_id": 2, "wallet": {"balance": 1.0, "holdings": {}}},
+    ])
+    pipeline = [
+        {"$project": {"user_id": 1, "h": {"$objectToArray": {"$ifNull": ["$wallet.holdings", {}]}}}},
+        {"$unwind": {"path": "$h", "preserveNullAndEmptyArrays": True}},
+        {"$lookup": {"from": "tokens", "localField": "h.k", "foreignField": "symbol", "as": "t"}},
+        {"$unwind": {"path": "$t", "preserveNullAndEmptyArrays": True}},
+        {"$group": {"_id": "$user_id", "assets": {"$sum": {"$multiply": [{"$ifNull": ["$h.v", 0]}, {"$ifNull": ["$t.price", 0]}]}}}},
+        {"$sort": {"assets": -1}},
+    ]
+    assert [(r["_id"], r["assets"]) for r in db.users.aggregate(pipeline)] == [(1, 30.0), (2, 0)]
+
+def test_group_count_by_status(txs):
+    pipeline = [{"$match": {"status": "pending"}}, {"$group": {"_id": "$type", "count": {"$sum": 1}, "total": {"$sum": "$amount"}}}]
+    assert {r["_id"]: (r["count"], r["total"]) for r in txs.aggregate(pipeline)} == {"deposit": (3, 37.0)}
+
+def test_sqlite_persists_across_reopen(tmp_path):
+    path = str(tmp_path / "wallet.db")
+    db = open_database("sqlite", sqlite_path=path)
+    db.ledger.create_index("entry_id", unique=True)
+    db.ledger.insert_one({"entry_id": "e1", "amount": 1.0})
+
+    reopened = open_database("sqlite", sqlite_path=path)
+    assert reopened.ledger.find_one({"entry_id": "e1"}, {"_id": 0}) == {"entry_id": "e1", "amount": 1.0}
+    with pytest.raises(DuplicateKeyError):
+        reopened.ledger.insert_one({"entry_id": "e1"})
+
+def test_sqlite_compound_unique_survives_reopen(tmp_path):
+    path = str(tmp_path / "wallet.db")
+    db = open_database("sqlite", sqlite_path=path)
+    db.portfolio_history.create_index([("user_id", 1), ("day", 1)], unique=True)
+    db.portfolio_history.insert_one({"user_id": 1, "day": "2024-01-01"})
+
+    reopened = open_database("sqlite", sqlite_path=path)
+    # Only the (user_id, day) pair is unique, a new day for the same user is fine
+    reopened.portfolio_history.update_one({"user_id": 1, "day": "2024-01-02"}, {"$push": {"points": [1, 2, 3]}}, upsert=True)
+    assert reopened.portfolio_history.count_documents({"user_id": 1}) == 2
+    with pytest.raises(DuplicateKeyError):
+        reopened.portfolio_history.insert_one({"user_id": 1, "day": "2024-01-01"})
+
+def test_compound_unique_index(db):
+    db.portfolio_history.create_index([("user_id", 1), ("day", 1)], unique=True)
+    db.portfolio_history.insert_many([{"user_id": 1, "day": "a"}, {"user_id": 1, "day": "b"}, {"user_id": 2, "day": "a"}])
+    with pytest.raises(DuplicateKeyError):
+        db.portfolio_history.insert_one({"user_id": 2, "day": "a"})
+    with pytest.raises(DuplicateKeyError):
+        db.portfolio_history.update_one({"user_id": 1, "day": "b"}, {"$set": {"day": "a"}})
+
+# ==========================================
+# 5. TRANSACTIONS
+# ==========================================
+def test_run_atomic_commits_and_returns(db):
+    db.users.insert_one({"user_id": 1, "wallet": {"balance": 10.0}})
+
+    def move(session):
+        db.users.update_one({"user_id": 1}, {"$inc": {"wallet.balance": -4.0}}, session=session)
+        db.ledger.insert_one({"entry_id": "e1", "user_id": 1, "amount": -4.0}, session=session)
+        return True
+    assert run_atomic(db, move) is True
+    assert db.users.find_one({"user_id": 1})["wallet"]["balance"] == 6.0
+    assert db.ledger.count_documents({"user_id": 1}) == 1
+
+def test_run_atomic_rolls_back_every_write(db):
+    db.ledger.create_index("entry_id", unique=True)
+    db.ledger.insert_one({"entry_id": "taken"})
+    db.users.insert_many([{"user_id": 1, "wallet": {"balance": 10.0}}, {"user_id": 2, "gone": True}])
+
+    def move(session):
+        db.users.update_one({"user_id": 1}, {"$inc": {"wallet.balance": 5.0}}, session=session)
+        db.users.insert_one({"user_id": 3}, session=session)
+        db.users.delete_one({"user_id": 2}, session=session)
+        db.ledger.insert_one({"entry_id": "taken"}, session=session)
+    with pytest.raises(DuplicateKeyError):
+        run_atomic(db, move)
+
+    assert db.users.find_one({"user_id": 1})["wallet"]["balance"] == 10.0
+    assert sorted(db.users.distinct("user_id")) == [1, 2]
+    assert db.users.count_documents({"user_id": 2, "gone": True}) == 1
+    assert db.ledger.count_documents({}) == 1